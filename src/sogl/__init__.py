@@ -24,6 +24,9 @@ from _bmpshape import *
 from _divided import *
 from _composit import *
 from _drawn import *
+from _sprite import *
+from _statedc import *
+from _overlay import *
 
 
 # Set things up for documenting with epydoc.  The __docfilter__ will
@@ -15,6 +15,7 @@ import wx
 import math
 
 from _soglmisc import *
+from _sprite import TheSpriteCache, SPRITE_MASK_COLOUR
 
 DragOffsetX = 0.0
 DragOffsetY = 0.0
@@ -232,6 +233,8 @@ class Shape(ShapeEvtHandler):
         self._canvas = canvas
         self._xpos = 0.0
         self._ypos = 0.0
+        self._worldBounds = None
+        self._attachmentPositions = None
         self._pen = wx.Pen(wx.BLACK, 1, wx.SOLID)
         self._brush = wx.WHITE_BRUSH
         self._font = wx.Font(10, wx.SWISS, wx.NORMAL, wx.NORMAL)
@@ -245,6 +248,7 @@ class Shape(ShapeEvtHandler):
         self._fixedWidth = False
         self._fixedHeight = False
         self._drawHandles = True
+        self._cacheSprite = False
         self._sensitivity = OP_ALL
         #self._draggable = True
         self._parent = None
@@ -268,6 +272,11 @@ class Shape(ShapeEvtHandler):
         self._regions = []
         self._lines = []
         self._controlPoints = []
+
+        # Index of the lines by attachment, see GetAttachmentLines
+        self._attachmentLines = None
+        self._attachmentLineEnds = None
+        self._attachmentLineCounts = None
         self._attachmentPoints = []
         self._text = []
         self._children = []
@@ -301,6 +310,7 @@ class Shape(ShapeEvtHandler):
         self.ClearText()
         self.ClearRegions()
         self.ClearAttachments()
+        TheSpriteCache.Discard(self)
 
         self._handlerShape = None
 
@@ -324,6 +334,16 @@ class Shape(ShapeEvtHandler):
         """Get the internal canvas."""
         return self._canvas
 
+    def GetBatchDiagram(self):
+        """Return the diagram of the shape if it is inside
+        Diagram.BatchUpdate, otherwise None.
+        """
+        if self._canvas:
+            diagram = self._canvas.GetDiagram()
+            if diagram and diagram.IsBatchUpdating():
+                return diagram
+        return None
+
     def GetBranchStyle(self):
         return self._branchStyle
 
@@ -333,6 +353,7 @@ class Shape(ShapeEvtHandler):
 
     def SetRotation(self, rotation):
         self._rotation = rotation
+        self.InvalidateBounds()
 
     def SetHighlight(self, hi, recurse = False):
         """Set the highlight for a shape. Shape highlighting is unimplemented."""
@@ -409,14 +430,26 @@ class Shape(ShapeEvtHandler):
             self.GetCanvas().PrepareDC(dc)
             self.Erase(dc)
             self._shadowMode = mode
+            self.InvalidateBounds()
+            self.InvalidateSprite()
             self.Draw(dc)
         else:
             self._shadowMode = mode
+            self.InvalidateBounds()
+            self.InvalidateSprite()
 
     def GetShadowMode(self):
         """Return the current shadow mode setting"""
         return self._shadowMode
 
+    def IsShadowShown(self, dc):
+        """TRUE if the shadow should be drawn on dc, that is the shadow mode
+        is set and the shadow offset is not too small to see at its scale.
+        """
+        if self._shadowMode == SHADOW_NONE:
+            return False
+        return max(abs(self._shadowOffsetX), abs(self._shadowOffsetY)) >= self.GetDetailLimits(dc)[1]
+
     def SetCanvas(self, theCanvas):
         """Identical to Shape.Attach."""
         self._canvas = theCanvas
@@ -458,6 +491,7 @@ class Shape(ShapeEvtHandler):
         wxAttachmentPoint).
         """
         self._attachmentPoints = []
+        self.InvalidateAttachments()
 
     def ClearText(self, regionId = 0):
         """Clear the text from the specified text region."""
@@ -465,6 +499,7 @@ class Shape(ShapeEvtHandler):
             self._text = ""
         if regionId < len(self._regions):
             self._regions[regionId].ClearText()
+        self.InvalidateSprite()
 
     def ClearRegions(self):
         """Clear the ShapeRegions from the shape."""
@@ -486,6 +521,12 @@ class Shape(ShapeEvtHandler):
         shape, and returns the nearest attachment point and distance from
         the given point and target.
         """
+        # Quick rejection using the cached bounds
+        left, top, right, bottom = self.GetWorldBounds()
+        if x < left - HIT_TOLERANCE or x > right + HIT_TOLERANCE or \
+           y < top - HIT_TOLERANCE or y > bottom + HIT_TOLERANCE:
+            return False
+
         width, height = self.GetBoundingBoxMax()
         if abs(width) < 4:
             width = 4.0
@@ -500,27 +541,10 @@ class Shape(ShapeEvtHandler):
         right = self._xpos + width / 2.0
         bottom = self._ypos + height / 2.0
 
-        nearest_attachment = 0
-
         # If within the bounding box, check the attachment points
         # within the object.
         if x >= left and x <= right and y >= top and y <= bottom:
-            n = self.GetNumberOfAttachments()
-            nearest = 999999
-
-            # GetAttachmentPosition[Edge] takes a logical attachment position,
-            # i.e. if it's rotated through 90%, position 0 is East-facing.
-
-            for i in range(n):
-                e = self.GetAttachmentPositionEdge(i)
-                if e:
-                    xp, yp = e
-                    l = math.sqrt(((xp - x) * (xp - x)) + (yp - y) * (yp - y))
-                    if l < nearest:
-                        nearest = l
-                        nearest_attachment = i
-
-            return nearest_attachment, nearest
+            return self.FindNearestAttachment(x, y)
         return False
 
     # Format a text string according to the region size, adding
@@ -605,10 +629,12 @@ class Shape(ShapeEvtHandler):
     def SetPen(self, the_pen):
         """Set the pen for drawing the shape's outline."""
         self._pen = the_pen
+        self.InvalidateSprite()
 
     def SetBrush(self, the_brush):
         """Set the brush for filling the shape's shape."""
         self._brush = the_brush
+        self.InvalidateSprite()
 
     # Get the top - most (non-division) ancestor, or self
     def GetTopAncestor(self):
@@ -628,6 +654,7 @@ class Shape(ShapeEvtHandler):
         self._font = the_font
         if regionId < len(self._regions):
             self._regions[regionId].SetFont(the_font)
+        self.InvalidateSprite()
 
     def GetFont(self, regionId = 0):
         """Get the font for the specified text region."""
@@ -648,6 +675,7 @@ class Shape(ShapeEvtHandler):
         """
         if regionId < len(self._regions):
             self._regions[regionId].SetFormatMode(mode)
+        self.InvalidateSprite()
 
     def GetFormatMode(self, regionId = 0):
         if regionId >= len(self._regions):
@@ -661,6 +689,7 @@ class Shape(ShapeEvtHandler):
 
         if regionId < len(self._regions):
             self._regions[regionId].SetColour(the_colour)
+        self.InvalidateSprite()
 
     def GetTextColour(self, regionId = 0):
         """Get the colour for the specified text region."""
@@ -744,7 +773,7 @@ class Shape(ShapeEvtHandler):
 
     def AssignNewIds(self):
         """Assign new ids to this image and its children."""
-        self._id = wx.NewId()
+        self.SetId(wx.NewId())
         for child in self._children:
             child.AssignNewIds()
 
@@ -778,7 +807,7 @@ class Shape(ShapeEvtHandler):
                 self._formatted = True
 
             if not self.GetDisableLabel():
-                DrawFormattedText(dc, region.GetFormattedText(), self._xpos, self._ypos, bound_x - 2 * self._textMarginX, bound_y - 2 * self._textMarginY, region.GetFormatMode())
+                DrawFormattedText(dc, region.GetFormattedText(), self._xpos, self._ypos, bound_x - 2 * self._textMarginX, bound_y - 2 * self._textMarginY, region.GetFormatMode(), self.GetGreekHeight(dc, region.GetFont()))
 
 
     def DrawContents(self, dc):
@@ -809,12 +838,7 @@ class Shape(ShapeEvtHandler):
         if not self._visible:
             return
 
-        xp, yp = self.GetX(), self.GetY()
-        minX, minY = self.GetBoundingBoxMin()
-        maxX, maxY = self.GetBoundingBoxMax()
-
-        topLeftX = xp - maxX / 2.0 - 2
-        topLeftY = yp - maxY / 2.0 - 2
+        left, top, right, bottom = self.GetWorldBounds()
 
         penWidth = 0
         if self._pen:
@@ -823,7 +847,7 @@ class Shape(ShapeEvtHandler):
         dc.SetPen(self.GetBackgroundPen())
         dc.SetBrush(self.GetBackgroundBrush())
 
-        dc.DrawRectangle(topLeftX - penWidth, topLeftY - penWidth, maxX + penWidth * 2 + 4, maxY + penWidth * 2 + 4)
+        dc.DrawRectangle(left - 2 - penWidth, top - 2 - penWidth, right - left + penWidth * 2 + 4, bottom - top + penWidth * 2 + 4)
 
     def EraseLinks(self, dc, attachment = -1, recurse = False):
         """Erase links attached to this shape, but do not repair damage
@@ -832,9 +856,13 @@ class Shape(ShapeEvtHandler):
         if not self._visible:
             return
 
-        for line in self._lines:
-            if attachment == -1 or (line.GetTo() == self and line.GetAttachmentTo() == attachment or line.GetFrom() == self and line.GetAttachmentFrom() == attachment):
-                line.GetEventHandler().OnErase(dc)
+        if attachment == -1:
+            lines = self._lines
+        else:
+            lines = self.GetAttachmentLines(attachment)
+
+        for line in lines:
+            line.GetEventHandler().OnErase(dc)
 
         if recurse:
             for child in self._children:
@@ -845,9 +873,13 @@ class Shape(ShapeEvtHandler):
         if not self._visible:
             return
 
-        for line in self._lines:
-            if attachment == -1 or (line.GetTo() == self and line.GetAttachmentTo() == attachment or line.GetFrom() == self and line.GetAttachmentFrom() == attachment):
-                line.Draw(dc)
+        if attachment == -1:
+            lines = self._lines
+        else:
+            lines = self.GetAttachmentLines(attachment)
+
+        for line in lines:
+            line.Draw(dc)
 
         if recurse:
             for child in self._children:
@@ -914,30 +946,30 @@ class Shape(ShapeEvtHandler):
 
         found = False
 
-        for line in newOrdering:
-            if line.GetTo() == self and oldAttachment == line.GetAttachmentTo() or \
-               line.GetFrom() == self and oldAttachment == line.GetAttachmentFrom():
-                startX, startY, endX, endY = line.GetEnds()
-                if line.GetTo() == self:
-                    xp = endX
-                    yp = endY
-                else:
-                    xp = startX
-                    yp = startY
+        for line in self.GetAttachmentLines(oldAttachment):
+            if line == to_move:
+                continue
 
-                thisPoint = wx.RealPoint(xp, yp)
-                lastPoint = wx.RealPoint(old_x, old_y)
-                newPoint = wx.RealPoint(x, y)
+            startX, startY, endX, endY = line.GetEnds()
+            if line.GetTo() == self:
+                xp = endX
+                yp = endY
+            else:
+                xp = startX
+                yp = startY
 
-                if self.AttachmentSortTest(newAttachment, newPoint, thisPoint) and self.AttachmentSortTest(newAttachment, lastPoint, newPoint):
-                    found = True
-                    newOrdering.insert(newOrdering.index(line), to_move)
+            thisPoint = wx.RealPoint(xp, yp)
+            lastPoint = wx.RealPoint(old_x, old_y)
+            newPoint = wx.RealPoint(x, y)
 
-                old_x = xp
-                old_y = yp
-            if found:
+            if self.AttachmentSortTest(newAttachment, newPoint, thisPoint) and self.AttachmentSortTest(newAttachment, lastPoint, newPoint):
+                found = True
+                newOrdering.insert(newOrdering.index(line), to_move)
                 break
 
+            old_x = xp
+            old_y = yp
+
         if not found:
             newOrdering.append(to_move)
 
@@ -957,24 +989,26 @@ class Shape(ShapeEvtHandler):
         self.MoveLinks(dc)
 
         if not self.GetCanvas().GetQuickEditMode():
-            self.GetCanvas().Redraw(dc)
+            self.GetCanvas().RefreshDamage()
 
     # Reorders the lines according to the given list
     def ApplyAttachmentOrdering(self, linesToSort):
         """Apply the line ordering in linesToSort to the shape, to reorder
         the way lines are attached.
         """
-        linesStore = self._lines[:]
-
-        self._lines = []
+        remaining = set(self._lines)
 
+        ordered = []
         for line in linesToSort:
-            if line in linesStore:
-                del linesStore[linesStore.index(line)]
-                self._lines.append(line)
+            if line in remaining:
+                remaining.remove(line)
+                ordered.append(line)
 
         # Now add any lines that haven't been listed in linesToSort
-        self._lines += linesStore
+        ordered += [line for line in self._lines if line in remaining]
+
+        self._lines = ordered
+        self.InvalidateAttachmentLines()
 
     def SortLines(self, attachment, linesToSort):
         """ Reorder the lines coming into the node image at this attachment
@@ -984,22 +1018,20 @@ class Shape(ShapeEvtHandler):
         """
         # This is a temporary store of all the lines at this attachment
         # point. We'll tick them off as we've processed them.
-        linesAtThisAttachment = []
+        linesAtThisAttachment = self.GetAttachmentLines(attachment)
+        remaining = set(linesAtThisAttachment)
 
-        for line in self._lines[:]:
-            if line.GetTo() == self and line.GetAttachmentTo() == attachment or \
-               line.GetFrom() == self and line.GetAttachmentFrom() == attachment:
-                linesAtThisAttachment.append(line)
-                del self._lines[self._lines.index(line)]
+        self._lines = [line for line in self._lines if line not in remaining]
 
         for line in linesToSort:
-            if line in linesAtThisAttachment:
+            if line in remaining:
                 # Done this one
-                del linesAtThisAttachment[linesAtThisAttachment.index(line)]
+                remaining.remove(line)
                 self._lines.append(line)
 
         # Now add any lines that haven't been listed in linesToSort
-        self._lines += linesAtThisAttachment
+        self._lines += [line for line in linesAtThisAttachment if line in remaining]
+        self.InvalidateAttachmentLines()
 
     def OnHighlight(self, dc):
         pass
@@ -1024,11 +1056,9 @@ class Shape(ShapeEvtHandler):
                 self._parent.GetEventHandler().OnDragLeft(draw, x, y, keys, attachment)
             return
 
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
-        dc.SetLogicalFunction(OGLRBLF)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -1053,17 +1083,15 @@ class Shape(ShapeEvtHandler):
         DragOffsetX = self._xpos - x
         DragOffsetY = self._ypos - y
 
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        dc = self.GetCanvas().GetOverlayDC()
 
         # New policy: don't erase shape until end of drag.
         # self.Erase(dc)
         xx = x + DragOffsetX
         yy = y + DragOffsetY
         xx, yy = self._canvas.Snap(xx, yy)
-        dc.SetLogicalFunction(OGLRBLF)
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -1095,7 +1123,7 @@ class Shape(ShapeEvtHandler):
 
         self.Move(dc, xx, yy)
         if self._canvas and not self._canvas.GetQuickEditMode():
-            self._canvas.Redraw(dc)
+            self._canvas.RefreshDamage()
 
     def OnDragRight(self, draw, x, y, keys = 0, attachment = 0):
         if not self.IsSensitiveTo(OP_DRAG_RIGHT):
@@ -1147,13 +1175,18 @@ class Shape(ShapeEvtHandler):
             return
 
         self._xpos, self._ypos = x, y
+        self.InvalidateBounds()
 
         self.ResetControlPoints()
 
-        if display:
+        batch = self.GetBatchDiagram()
+        if display and not batch:
             self.Draw(dc)
 
-        self.MoveLinks(dc)
+        if batch:
+            batch.DeferLinkMoves(self._lines)
+        else:
+            self.MoveLinks(dc)
 
         self.GetEventHandler().OnMovePost(dc, x, y, old_x, old_y, display)
 
@@ -1168,11 +1201,138 @@ class Shape(ShapeEvtHandler):
         by this function.
         """
         if self._visible:
-            self.GetEventHandler().OnDraw(dc)
-            self.GetEventHandler().OnDrawContents(dc)
+            if not self._selected:
+                shapeSize = self.GetDetailLimits(dc)[2]
+                if shapeSize:
+                    w, h = self.GetBoundingBoxMax()
+                    if w < shapeSize and h < shapeSize:
+                        self.DrawSimplified(dc)
+                        return
+
+            if not self._cacheSprite or not self.DrawSprite(dc):
+                self.GetEventHandler().OnDraw(dc)
+                self.GetEventHandler().OnDrawContents(dc)
             self.GetEventHandler().OnDrawControlPoints(dc)
             self.GetEventHandler().OnDrawBranches(dc)
 
+    def GetDetailLimits(self, dc):
+        """Return the level of detail thresholds of the diagram in logical
+        units at the scale of dc, as a (greekTextSize, minDetailSize,
+        minShapeSize) tuple. See Diagram.SetDetailThresholds.
+
+        The level of detail only applies to zoomed out views; at a user
+        scale of 1 or more all thresholds are 0.
+        """
+        scale = dc.GetUserScale()[0]
+        if scale >= 1 or scale <= 0:
+            return 0, 0, 0
+
+        if self._canvas and self._canvas.GetDiagram():
+            thresholds = self._canvas.GetDiagram().GetDetailThresholds()
+        else:
+            thresholds = GREEK_TEXT_SIZE, MIN_DETAIL_SIZE, MIN_SHAPE_SIZE
+        return tuple(size / scale for size in thresholds)
+
+    def GetGreekHeight(self, dc, font):
+        """Return the height of the bars drawn in place of text in the
+        given font, or 0 if the text is large enough to be drawn.
+        """
+        if font is None:
+            return 0
+        greekSize = self.GetDetailLimits(dc)[0]
+        if not greekSize:
+            return 0
+
+        # Compare the text height in logical units, not points
+        height = font.GetPointSize() * dc.GetPPI()[1] / 72.0
+        if height < greekSize:
+            return height
+        return 0
+
+    def DrawSimplified(self, dc):
+        """Draw the shape as a filled rectangle. Used in place of Draw when
+        the shape is too small on screen for its details to be seen.
+        """
+        w, h = self.GetBoundingBoxMin()
+        if self._pen:
+            dc.SetPen(self._pen)
+        if self._brush:
+            dc.SetBrush(self._brush)
+        dc.DrawRectangle(self._xpos - w / 2.0, self._ypos - h / 2.0, w, h)
+
+    def GetBatchLine(self):
+        """If drawing the shape amounts to a single straight line, return
+        (pen, (x1, y1, x2, y2)) so Diagram.Redraw can draw it together with
+        neighbouring lines using the same pen. Otherwise return None.
+        """
+        return None
+
+    def SetCacheSprite(self, cache):
+        """If TRUE, the shape and its text are rendered once into a bitmap
+        (a sprite) which is then drawn instead, until the look of the shape
+        changes. Useful for shapes that are expensive to draw.
+
+        Sprites are kept in TheSpriteCache, which has a memory budget.
+        """
+        self._cacheSprite = cache
+        if not cache:
+            TheSpriteCache.Discard(self)
+
+    def GetCacheSprite(self):
+        """TRUE if the shape is drawn from a cached sprite."""
+        return self._cacheSprite
+
+    def InvalidateSprite(self):
+        """Discard the cached sprite of the shape.
+
+        Setters such as SetPen or FormatText do this automatically; call it
+        after changing what the shape draws in other ways, e.g. through its
+        regions.
+        """
+        if self._cacheSprite:
+            TheSpriteCache.Discard(self)
+
+    def GetSpriteKey(self):
+        """Return a value describing any state, besides the size, rotation
+        and selection, that the look of the shape depends on. The cached
+        sprite is only used while this value stays the same.
+        """
+        return None
+
+    def DrawSprite(self, dc):
+        """Draw the shape and its text from the cached sprite, rendering the
+        sprite first if needed. Returns FALSE if the shape has to be drawn
+        directly on dc instead.
+        """
+        # Sprites are rendered at the natural scale and copied as is
+        if dc.GetLogicalFunction() != wx.COPY or dc.GetUserScale() != (1, 1):
+            return False
+
+        left, top, right, bottom = self.GetWorldBounds()
+        left = int(math.floor(left)) - DAMAGE_MARGIN
+        top = int(math.floor(top)) - DAMAGE_MARGIN
+        width = int(math.ceil(right)) + DAMAGE_MARGIN - left
+        height = int(math.ceil(bottom)) + DAMAGE_MARGIN - top
+
+        key = width, height, self._xpos - left, self._ypos - top, self._rotation, self._selected, self.GetSpriteKey()
+        sprite = TheSpriteCache.Get(self, key)
+        if sprite is None:
+            sprite = wx.EmptyBitmap(width, height)
+            mdc = wx.MemoryDC()
+            mdc.SelectObject(sprite)
+            mdc.SetBackground(FindOrCreateBrush(SPRITE_MASK_COLOUR, wx.SOLID))
+            mdc.Clear()
+            mdc.SetDeviceOrigin(-left, -top)
+            self.GetEventHandler().OnDraw(mdc)
+            self.GetEventHandler().OnDrawContents(mdc)
+            mdc.SelectObject(wx.NullBitmap)
+
+            sprite.SetMask(wx.Mask(sprite, SPRITE_MASK_COLOUR))
+            TheSpriteCache.Put(self, key, sprite)
+
+        dc.DrawBitmap(sprite, left, top, True)
+        return True
+
     def Flash(self):
         """Flash the shape."""
         if self.GetCanvas():
@@ -1194,6 +1354,10 @@ class Shape(ShapeEvtHandler):
         """Erase the shape.
         Does not repair damage caused to other shapes.
         """
+        # The damaged area is repainted at the end of a batch update
+        if self.GetBatchDiagram():
+            return
+
         self.GetEventHandler().OnErase(dc)
         self.GetEventHandler().OnEraseControlPoints(dc)
         self.GetEventHandler().OnDrawBranches(dc, erase = True)
@@ -1216,11 +1380,13 @@ class Shape(ShapeEvtHandler):
         text.append(new_line)
 
         self._formatted = False
+        self.InvalidateSprite()
 
     def SetSize(self, x, y, recursive = True):
         """Set the shape's size."""
         self.SetAttachmentSize(x, y)
         self.SetDefaultRegionSize()
+        self.InvalidateBounds()
 
     def SetAttachmentSize(self, w, h):
         width, height = self.GetBoundingBoxMin()
@@ -1277,6 +1443,8 @@ class Shape(ShapeEvtHandler):
         line.SetFrom(self)
         line.SetTo(other)
         line.SetAttachments(attachFrom, attachTo)
+        self.InvalidateAttachmentLines()
+        other.InvalidateAttachmentLines()
 
         dc = wx.ClientDC(self._canvas)
         self._canvas.PrepareDC(dc)
@@ -1286,10 +1454,13 @@ class Shape(ShapeEvtHandler):
         """Remove the given line from the shape's list of attached lines."""
         if line.GetFrom() == self:
             line.GetTo()._lines.remove(line)
+            line.GetTo().InvalidateAttachmentLines()
         else:
             line.GetFrom()._lines.remove(line)
+            line.GetFrom().InvalidateAttachmentLines()
 
         self._lines.remove(line)
+        self.InvalidateAttachmentLines()
 
     # Default - make 6 control points
     def MakeControlPoints(self):
@@ -1564,6 +1735,57 @@ class Shape(ShapeEvtHandler):
         """
         return 0, 0
 
+    def GetWorldBounds(self):
+        """Return the (left, top, right, bottom) rectangle covered by the
+        shape on the canvas, including its shadow.
+
+        The rectangle is cached until the geometry of the shape changes,
+        so this is cheap to call.
+        """
+        if self._worldBounds is None:
+            self._worldBounds = self.CalculateWorldBounds()
+        return self._worldBounds
+
+    def CalculateWorldBounds(self):
+        """Calculate the rectangle returned by GetWorldBounds.
+
+        Derived classes with a non-rectangular extent override this rather
+        than GetWorldBounds.
+        """
+        w, h = self.GetBoundingBoxMax()
+        left = self._xpos - w / 2.0
+        top = self._ypos - h / 2.0
+        right = self._xpos + w / 2.0
+        bottom = self._ypos + h / 2.0
+
+        # The shadow is drawn at an offset from the shape itself
+        if self._shadowMode != SHADOW_NONE:
+            minW, minH = self.GetBoundingBoxMin()
+            right = max(right, self._xpos + minW / 2.0 + self._shadowOffsetX)
+            bottom = max(bottom, self._ypos + minH / 2.0 + self._shadowOffsetY)
+
+        # Branches are drawn out from the edges of the shape
+        if self._attachmentMode == ATTACHMENT_MODE_BRANCHING:
+            extra = self._branchNeckLength + self._branchStemLength + BRANCH_BLOB_SIZE / 2.0
+            left -= extra
+            top -= extra
+            right += extra
+            bottom += extra
+
+        return left, top, right, bottom
+
+    def InvalidateBounds(self):
+        """Discard the cached bounds of the shape and notify the diagram
+        that its geometry has changed.
+
+        Must be called whenever the position or extent of the shape is
+        changed other than through Move, SetSize or Rotate.
+        """
+        self._worldBounds = None
+        self._attachmentPositions = None
+        if self._canvas and self._canvas.GetDiagram():
+            self._canvas.GetDiagram().InvalidateShapeBounds(self)
+
     def HasDescendant(self, image):
         """TRUE if image is a descendant of this composite."""
         if image == self:
@@ -1775,13 +1997,64 @@ class Shape(ShapeEvtHandler):
 
     def GetAttachmentLineCount(self, attachment):
         """Get the number of lines at this attachment position."""
-        count = 0
-        for lineShape in self._lines:
-            if lineShape.GetFrom() == self and lineShape.GetAttachmentFrom() == attachment:
-                count += 1
-            elif lineShape.GetTo() == self and lineShape.GetAttachmentTo() == attachment:
-                count += 1
-        return count
+        return len(self.GetAttachmentLines(attachment))
+
+    def GetAttachmentLines(self, attachment):
+        """Return the lines with an end at the given attachment, in the order
+        of the shape's list of lines.
+        """
+        if self._attachmentLines is None:
+            self._BuildAttachmentLines()
+        return self._attachmentLines.get(attachment, [])
+
+    def GetAttachmentLineEnd(self, line, incoming):
+        """Return the position of the incoming or outgoing end of line among
+        the line ends at its attachment, or -1 if the line has no such end
+        at this shape.
+        """
+        if self._attachmentLines is None:
+            self._BuildAttachmentLines()
+        return self._attachmentLineEnds.get((line, incoming), -1)
+
+    def GetAttachmentEndCount(self, attachment):
+        """Return the number of line ends at the given attachment. Unlike
+        GetAttachmentLineCount, a line with both ends there counts twice.
+        """
+        if self._attachmentLines is None:
+            self._BuildAttachmentLines()
+        return self._attachmentLineCounts.get(attachment, 0)
+
+    def InvalidateAttachmentLines(self):
+        """Discard the index of lines by attachment. This is done by AddLine,
+        RemoveLine, SortLines and the LineShape setters; call it after
+        changing the list returned by GetLines directly.
+        """
+        self._attachmentLines = None
+        self._attachmentLineEnds = None
+        self._attachmentLineCounts = None
+
+    def _BuildAttachmentLines(self):
+        # A line looping back to this shape has two ends here, but is
+        # listed only once per attachment
+        lines = {}
+        ends = {}
+        counts = {}
+        for line in self._lines:
+            if line._from == self:
+                attachment = line._attachmentFrom
+                ends[line, False] = counts.get(attachment, 0)
+                counts[attachment] = ends[line, False] + 1
+                lines.setdefault(attachment, []).append(line)
+            if line._to == self:
+                attachment = line._attachmentTo
+                ends[line, True] = counts.get(attachment, 0)
+                counts[attachment] = ends[line, True] + 1
+                if not (line._from == self and line._attachmentFrom == attachment):
+                    lines.setdefault(attachment, []).append(line)
+
+        self._attachmentLines = lines
+        self._attachmentLineEnds = ends
+        self._attachmentLineCounts = counts
 
     def GetBranchingAttachmentRoot(self, attachment):
         """Get the root point at the given attachment."""
@@ -1836,12 +2109,13 @@ class Shape(ShapeEvtHandler):
             dc.DrawLine(stemPt[0], stemPt[1], pt[0], pt[1])
 
             if self.GetBranchStyle() & BRANCHING_ATTACHMENT_BLOB and count > 1:
-                blobSize = 6.0
-                dc.DrawEllipse(stemPt[0] - blobSize / 2.0, stemPt[1] - blobSize / 2.0, blobSize, blobSize)
+                dc.DrawEllipse(stemPt[0] - BRANCH_BLOB_SIZE / 2.0, stemPt[1] - BRANCH_BLOB_SIZE / 2.0, BRANCH_BLOB_SIZE, BRANCH_BLOB_SIZE)
 
     def OnDrawBranches(self, dc, erase = False):
         if self._attachmentMode != ATTACHMENT_MODE_BRANCHING:
             return
+        if max(self._branchNeckLength, self._branchStemLength) < self.GetDetailLimits(dc)[1]:
+            return
         for i in range(self.GetNumberOfAttachments()):
             self.OnDrawBranchesAttachment(dc, i, erase)
 
@@ -1860,6 +2134,49 @@ class Shape(ShapeEvtHandler):
 
         return res
 
+    def GetAttachmentPositions(self):
+        """Return a list of (attachment, x, y) tuples giving the edge
+        position of every attachment point of the shape.
+
+        The list is cached until the shape's geometry or attachment points
+        change, and must not be modified.
+        """
+        if self._attachmentPositions is None:
+            # GetAttachmentPosition[Edge] takes a logical attachment position,
+            # i.e. if it's rotated through 90%, position 0 is East-facing.
+            positions = []
+            for i in range(self.GetNumberOfAttachments()):
+                e = self.GetAttachmentPositionEdge(i)
+                if e:
+                    positions.append((i, e[0], e[1]))
+            self._attachmentPositions = positions
+        return self._attachmentPositions
+
+    def InvalidateAttachments(self):
+        """Discard the cached attachment positions.
+
+        Must be called after changing the attachment points directly
+        rather than through ClearAttachments or SetAttachmentMode.
+        """
+        self._attachmentPositions = None
+
+    def FindNearestAttachment(self, x, y):
+        """Return the attachment nearest to the given point and its distance
+        from the point.
+        """
+        nearest_attachment = 0
+        nearest = None
+
+        for i, xp, yp in self.GetAttachmentPositions():
+            d = (xp - x) * (xp - x) + (yp - y) * (yp - y)
+            if nearest is None or d < nearest:
+                nearest = d
+                nearest_attachment = i
+
+        if nearest is None:
+            return nearest_attachment, 999999
+        return nearest_attachment, math.sqrt(nearest)
+
     def PhysicalToLogicalAttachment(self, physicalAttachment):
         """ Rotate the standard attachment point from physical
         (0 is always North) to logical (0 -> 1 if rotated by 90 degrees)
@@ -1908,17 +2225,18 @@ class Shape(ShapeEvtHandler):
             self._rotation += 2 * math.pi
         elif self._rotation > 2 * math.pi:
             self._rotation -= 2 * math.pi
+        self.InvalidateBounds()
 
     def GetBackgroundPen(self):
         """Return pen of the right colour for the background."""
         if self.GetCanvas():
-            return wx.Pen(self.GetCanvas().GetBackgroundColour(), 1, wx.SOLID)
+            return FindOrCreatePen(self.GetCanvas().GetBackgroundColour(), 1, wx.SOLID)
         return WhiteBackgroundPen
 
     def GetBackgroundBrush(self):
         """Return brush of the right colour for the background."""
         if self.GetCanvas():
-            return wx.Brush(self.GetCanvas().GetBackgroundColour(), wx.SOLID)
+            return FindOrCreateBrush(self.GetCanvas().GetBackgroundColour(), wx.SOLID)
         return WhiteBackgroundBrush
 
     def GetX(self):
@@ -1932,10 +2250,12 @@ class Shape(ShapeEvtHandler):
     def SetX(self, x):
         """Set the x position of the shape."""
         self._xpos = x
+        self.InvalidateBounds()
 
     def SetY(self, y):
         """Set the y position of the shape."""
         self._ypos = y
+        self.InvalidateBounds()
 
     def GetParent(self):
         """Return the parent of this shape, if it is part of a composite."""
@@ -2043,6 +2363,7 @@ class Shape(ShapeEvtHandler):
     def SetDisableLabel(self, flag):
         """Set flag to TRUE to stop the default region being shown."""
         self._disableLabel = flag
+        self.InvalidateSprite()
 
     def GetDisableLabel(self):
         """TRUE if the default region will not be shown, FALSE otherwise."""
@@ -2056,6 +2377,8 @@ class Shape(ShapeEvtHandler):
         If FALSE, lines will be drawn as if to the centre of the shape.
         """
         self._attachmentMode = mode
+        # Branches change the extent of the shape
+        self.InvalidateBounds()
 
     def GetAttachmentMode(self):
         """Return the attachment mode.
@@ -2066,7 +2389,10 @@ class Shape(ShapeEvtHandler):
 
     def SetId(self, i):
         """Set the integer identifier for this shape."""
+        oldId = self._id
         self._id = i
+        if self._canvas and self._canvas.GetDiagram():
+            self._canvas.GetDiagram().ShapeIdChanged(self, oldId)
 
     def GetId(self):
         """Return the integer identifier for this shape."""
@@ -2102,12 +2428,9 @@ class Shape(ShapeEvtHandler):
     def OnSizingDragLeft(self, pt, draw, x, y, keys = 0, attachment = 0):
         bound_x, bound_y = self.GetBoundingBoxMin()
 
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dc.SetLogicalFunction(OGLRBLF)
-
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -2183,10 +2506,7 @@ class Shape(ShapeEvtHandler):
     def OnSizingBeginDragLeft(self, pt, x, y, keys = 0, attachment = 0):
         self._canvas.CaptureMouse()
 
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
-
-        dc.SetLogicalFunction(OGLRBLF)
+        dc = self.GetCanvas().GetOverlayDC()
 
         bound_x, bound_y = self.GetBoundingBoxMin()
         self.GetEventHandler().OnBeginSize(bound_x, bound_y)
@@ -2212,7 +2532,7 @@ class Shape(ShapeEvtHandler):
         pt._controlPointDragStartWidth = bound_x
         pt._controlPointDragStartHeight = bound_y
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -2316,7 +2636,7 @@ class Shape(ShapeEvtHandler):
         self.GetEventHandler().OnEndSize(width, height)
 
         if not self._canvas.GetQuickEditMode() and pt._eraseObject:
-            self._canvas.Redraw(dc)
+            self._canvas.RefreshDamage()
 
 
 
@@ -2338,7 +2658,7 @@ class RectangleShape(Shape):
         x1 = self._xpos - self._width / 2.0
         y1 = self._ypos - self._height / 2.0
 
-        if self._shadowMode != SHADOW_NONE:
+        if self.IsShadowShown(dc):
             if self._shadowBrush:
                 dc.SetBrush(self._shadowBrush)
             dc.SetPen(TransparentPen)
@@ -2369,6 +2689,7 @@ class RectangleShape(Shape):
         self._width = max(x, 1)
         self._height = max(y, 1)
         self.SetDefaultRegionSize()
+        self.InvalidateBounds()
 
     def GetCornerRadius(self):
         """Get the radius of the rectangle's rounded corners."""
@@ -2396,9 +2717,11 @@ class RectangleShape(Shape):
 
     def SetWidth(self, w):
         self._width = w
+        self.InvalidateBounds()
 
     def SetHeight(self, h):
         self._height = h
+        self.InvalidateBounds()
 
 
 
@@ -2412,6 +2735,9 @@ class PolygonShape(Shape):
 
         self._points = None
         self._originalPoints = None
+        self._boundWidth = 0.0
+        self._boundHeight = 0.0
+        self._worldPoints = None
 
     def Create(self, the_points = None):
         """Takes a list of wx.RealPoints or tuples; each point is an offset
@@ -2438,11 +2764,42 @@ class PolygonShape(Shape):
     def ClearPoints(self):
         self._points = []
         self._originalPoints = []
+        self.InvalidateBounds()
 
     # Width and height. Centre of object is centre of box
     def GetBoundingBoxMin(self):
         return self._boundWidth, self._boundHeight
 
+    def InvalidateBounds(self):
+        self._worldPoints = None
+        Shape.InvalidateBounds(self)
+
+    def GetWorldPoints(self):
+        """Return the x and y vectors of the polygon vertices in canvas
+        coordinates.
+
+        The vectors are cached until the polygon is moved, resized or
+        rotated, and must not be modified.
+        """
+        if self._worldPoints is None:
+            xpoints = []
+            ypoints = []
+            for point in self._points or []:
+                xpoints.append(point[0] + self._xpos)
+                ypoints.append(point[1] + self._ypos)
+            self._worldPoints = xpoints, ypoints
+        return self._worldPoints
+
+    def CalculateWorldBounds(self):
+        left, top, right, bottom = Shape.CalculateWorldBounds(self)
+        # The vertices need not be centred on the shape position
+        for point in self._points or []:
+            left = min(left, point[0] + self._xpos)
+            top = min(top, point[1] + self._ypos)
+            right = max(right, point[0] + self._xpos)
+            bottom = max(bottom, point[1] + self._ypos)
+        return left, top, right, bottom
+
     def GetPoints(self):
         """Return the internal list of polygon vertices."""
         return self._points
@@ -2482,6 +2839,7 @@ class PolygonShape(Shape):
 
         self._boundWidth = right - left
         self._boundHeight = bottom - top
+        self.InvalidateBounds()
 
     def CalculatePolygonCentre(self):
         """Recalculates the centre of the polygon, and
@@ -2516,48 +2874,20 @@ class PolygonShape(Shape):
             self._points[i] = self._points[i][0] - newCentreX, self._points[i][1] - newCentreY
         self._xpos += newCentreX
         self._ypos += newCentreY
+        self.InvalidateBounds()
 
     def HitTest(self, x, y):
-        # Imagine four lines radiating from this point. If all of these lines
-        # hit the polygon, we're inside it, otherwise we're not. Obviously
-        # we'd need more radiating lines to be sure of correct results for
-        # very strange (concave) shapes.
-        endPointsX = [x, x + 1000, x, x - 1000]
-        endPointsY = [y - 1000, y, y + 1000, y]
-
-        xpoints = []
-        ypoints = []
-
-        for point in self._points:
-            xpoints.append(point[0] + self._xpos)
-            ypoints.append(point[1] + self._ypos)
-
-        # We assume it's inside the polygon UNLESS one or more
-        # lines don't hit the outline.
-        isContained = True
-
-        for i in range(4):
-            if not PolylineHitTest(xpoints, ypoints, x, y, endPointsX[i], endPointsY[i]):
-                isContained = False
-
-        if not isContained:
+        # Quick rejection using the cached bounds
+        left, top, right, bottom = self.GetWorldBounds()
+        if x < left or x > right or y < top or y > bottom:
             return False
 
-        nearest_attachment = 0
+        xpoints, ypoints = self.GetWorldPoints()
+        if not xpoints or not PointInPolygon(xpoints, ypoints, x, y):
+            return False
 
         # If a hit, check the attachment points within the object
-        nearest = 999999
-
-        for i in range(self.GetNumberOfAttachments()):
-            e = self.GetAttachmentPositionEdge(i)
-            if e:
-                xp, yp = e
-                l = math.sqrt((xp - x) * (xp - x) + (yp - y) * (yp - y))
-                if l < nearest:
-                    nearest = l
-                    nearest_attachment = i
-
-        return nearest_attachment, nearest
+        return self.FindNearestAttachment(x, y)
 
     # Really need to be able to reset the shape! Otherwise, if the
     # points ever go to zero, we've lost it, and can't resize.
@@ -2574,6 +2904,7 @@ class PolygonShape(Shape):
         self._boundWidth = abs(new_width)
         self._boundHeight = abs(new_height)
         self.SetDefaultRegionSize()
+        self.InvalidateBounds()
 
     # Make the original points the same as the working points
     def UpdateOriginalPoints(self):
@@ -2642,16 +2973,11 @@ class PolygonShape(Shape):
                     elif y2 < y1 and point[1] < 0:
                         return point[0] + self._xpos, point[1] + self._ypos
 
-        xpoints = []
-        ypoints = []
-        for point in self._points:
-            xpoints.append(point[0] + self._xpos)
-            ypoints.append(point[1] + self._ypos)
-
+        xpoints, ypoints = self.GetWorldPoints()
         return FindEndForPolyline(xpoints, ypoints, x1, y1, x2, y2)
 
     def OnDraw(self, dc):
-        if self._shadowMode != SHADOW_NONE:
+        if self.IsShadowShown(dc):
             if self._shadowBrush:
                 dc.SetBrush(self._shadowBrush)
             dc.SetPen(TransparentPen)
@@ -2752,16 +3078,14 @@ class PolygonShape(Shape):
         self.CalculatePolygonCentre()
         self.CalculateBoundingBox()
         self.ResetControlPoints()
+        self.InvalidateBounds()
 
     # Control points ('handles') redirect control to the actual shape, to
     # make it easier to override sizing behaviour.
     def OnSizingDragLeft(self, pt, draw, x, y, keys = 0, attachment = 0):
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
-
-        dc.SetLogicalFunction(OGLRBLF)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -2772,12 +3096,20 @@ class PolygonShape(Shape):
         self.GetEventHandler().OnDrawOutline(dc, self.GetX(), self.GetY(), pt.GetNewSize()[0], pt.GetNewSize()[1])
 
     def OnSizingBeginDragLeft(self, pt, x, y, keys = 0, attachment = 0):
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        if self._canvas.GetBufferedMode():
+            # Drawing on the window would be undone by the next paint from
+            # the buffer, so leave the polygon out of the buffer until the
+            # drag ends
+            self.Show(False)
+            self._canvas.GetDiagram().AddDamage(*self.GetWorldBounds())
+            self._canvas.RefreshDamage()
+        else:
+            dc = wx.ClientDC(self.GetCanvas())
+            self.GetCanvas().PrepareDC(dc)
 
-        self.Erase(dc)
+            self.Erase(dc)
 
-        dc.SetLogicalFunction(OGLRBLF)
+        dc = self.GetCanvas().GetOverlayDC()
 
         bound_x, bound_y = self.GetBoundingBoxMin()
 
@@ -2790,7 +3122,7 @@ class PolygonShape(Shape):
         if pt._originalDistance == 0:
             pt._originalDistance = 0.0001
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -2810,6 +3142,10 @@ class PolygonShape(Shape):
             self._canvas.ReleaseMouse()
         dc.SetLogicalFunction(wx.COPY)
 
+        if self._canvas.GetBufferedMode():
+            self.Show(True)
+            self._canvas.GetDiagram().AddDamage(*self.GetWorldBounds())
+
         # If we're changing shape, must reset the original points
         if keys & KEY_CTRL:
             self.CalculateBoundingBox()
@@ -2821,7 +3157,7 @@ class PolygonShape(Shape):
         self.ResetControlPoints()
         self.Move(dc, self.GetX(), self.GetY())
         if not self._canvas.GetQuickEditMode():
-            self._canvas.Redraw(dc)
+            self._canvas.RefreshDamage()
 
 
 
@@ -2854,12 +3190,14 @@ class EllipseShape(Shape):
 
     def SetWidth(self, w):
         self._width = w
+        self.InvalidateBounds()
 
     def SetHeight(self, h):
         self._height = h
+        self.InvalidateBounds()
 
     def OnDraw(self, dc):
-        if self._shadowMode != SHADOW_NONE:
+        if self.IsShadowShown(dc):
             if self._shadowBrush:
                 dc.SetBrush(self._shadowBrush)
             dc.SetPen(TransparentPen)
@@ -2881,6 +3219,7 @@ class EllipseShape(Shape):
         self._width = x
         self._height = y
         self.SetDefaultRegionSize()
+        self.InvalidateBounds()
 
     def GetNumberOfAttachments(self):
         return Shape.GetNumberOfAttachments(self)
@@ -3135,8 +3474,11 @@ class ControlPoint(RectangleShape):
         pass
 
     def OnDraw(self, dc):
-        self._xpos = self._shape.GetX() + self._xoffset
-        self._ypos = self._shape.GetY() + self._yoffset
+        x = self._shape.GetX() + self._xoffset
+        y = self._shape.GetY() + self._yoffset
+        if x != self._xpos or y != self._ypos:
+            self._xpos, self._ypos = x, y
+            self.InvalidateBounds()
         RectangleShape.OnDraw(self, dc)
 
     def OnErase(self, dc):
@@ -39,6 +39,7 @@ class BitmapShape(RectangleShape):
         self._height = h
 
         self.SetDefaultRegionSize()
+        self.InvalidateBounds()
 
     def GetBitmap(self):
         """Return a the bitmap associated with this shape."""
@@ -52,6 +53,7 @@ class BitmapShape(RectangleShape):
         data.
         """
         self._bitmap = bitmap
+        self.InvalidateSprite()
         if self._bitmap.Ok():
             self.SetSize(self._bitmap.GetWidth(), self._bitmap.GetHeight())
 
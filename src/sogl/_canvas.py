@@ -11,8 +11,12 @@
 # Licence:      wxWindows license
 #----------------------------------------------------------------------------
 
+import math
+
 import wx
 from _lines import LineShape
+from _spatial import DEFAULT_CELL_SIZE, MergeRects
+from _overlay import Overlay, OverlayDC, GetOperationBounds
 from _composit import *
 
 NoDragging, StartDraggingLeft, ContinueDraggingLeft, StartDraggingRight, ContinueDraggingRight = 0, 1, 2, 3, 4
@@ -23,21 +27,8 @@ KEY_SHIFT, KEY_CTRL = 1, 2
 
 # Helper function: True if 'contains' wholly contains 'contained'.
 def WhollyContains(contains, contained):
-    xp1, yp1 = contains.GetX(), contains.GetY()
-    xp2, yp2 = contained.GetX(), contained.GetY()
-
-    w1, h1 = contains.GetBoundingBoxMax()
-    w2, h2 = contained.GetBoundingBoxMax()
-
-    left1 = xp1 - w1 / 2.0
-    top1 = yp1 - h1 / 2.0
-    right1 = xp1 + w1 / 2.0
-    bottom1 = yp1 + h1 / 2.0
-
-    left2 = xp2 - w2 / 2.0
-    top2 = yp2 - h2 / 2.0
-    right2 = xp2 + w2 / 2.0
-    bottom2 = yp2 + h2 / 2.0
+    left1, top1, right1, bottom1 = contains.GetWorldBounds()
+    left2, top2, right2, bottom2 = contained.GetWorldBounds()
 
     return ((left1 <= left2) and (top1 <= top2) and (right1 >= right2) and (bottom1 >= bottom2))
 
@@ -55,8 +46,23 @@ class ShapeCanvas(wx.ScrolledWindow):
         self._firstDragX = 0
         self._firstDragY = 0
         self._checkTolerance = True
+        self._coalesceMotion = False
+        self._pendingMotion = None
+
+        # Off-screen copy of the window contents in buffered mode, see
+        # SetBufferedMode
+        self._bufferedMode = False
+        self._buffer = None
+        self._spareBuffer = None
+        self._bufferOrigin = None
+        self._bufferScale = None
+        self._bufferDirty = []
+
+        # Interactive feedback drawn over the buffer, see GetOverlayDC
+        self._overlay = Overlay()
 
         wx.EVT_PAINT(self, self.OnPaint)
+        wx.EVT_ERASE_BACKGROUND(self, self.OnEraseBackground)
         wx.EVT_MOUSE_EVENTS(self, self.OnMouseEvent)
 
     def SetDiagram(self, diag):
@@ -65,21 +71,328 @@ class ShapeCanvas(wx.ScrolledWindow):
     def GetDiagram(self):
         return self._shapeDiagram
 
+    def SetBufferedMode(self, mode):
+        """If TRUE, the diagram is rendered into an off-screen bitmap which is
+        copied to the window on paint. Only the parts of the bitmap where the
+        diagram changed, or that were scrolled into view, are rendered again.
+
+        Changes must be made known through RefreshDamage, Refresh or
+        RefreshRect so that the bitmap is brought up to date.
+        """
+        self._bufferedMode = mode
+        self._buffer = None
+        self._spareBuffer = None
+        self._bufferDirty = []
+
+    def GetBufferedMode(self):
+        """Return TRUE if the canvas is in buffered mode."""
+        return self._bufferedMode
+
+    def Refresh(self, eraseBackground = True, rect = None):
+        if self._bufferedMode:
+            if rect is None:
+                self._buffer = None
+            else:
+                self._InvalidateBuffer(*rect)
+        wx.ScrolledWindow.Refresh(self, eraseBackground, rect)
+
+    def RefreshRect(self, rect, eraseBackground = True):
+        if self._bufferedMode:
+            self._InvalidateBuffer(*rect)
+        wx.ScrolledWindow.RefreshRect(self, rect, eraseBackground)
+
+    def GetOverlayDC(self):
+        """Return a DC for drawing interactive feedback such as drag outlines
+        and rubber bands, prepared and set to draw with OGLRBLF. Drawing the
+        same thing a second time erases it again.
+
+        In buffered mode, what is drawn goes into the overlay, which is
+        painted over the buffer, so the diagram is left untouched. Otherwise
+        this is a ClientDC drawing straight onto the window.
+        """
+        dc = wx.ClientDC(self)
+        self.PrepareDC(dc)
+        if self._bufferedMode:
+            return OverlayDC(self, dc)
+        dc.SetLogicalFunction(OGLRBLF)
+        return dc
+
+    def GetOverlay(self):
+        """Return the Overlay painted over the buffer in buffered mode."""
+        return self._overlay
+
+    def ToggleOverlay(self, op):
+        """Add a (name, args, pen, brush, logicalFunction) drawing operation
+        to the overlay, or remove it if it is already there, and repaint the
+        part of the window it covers.
+        """
+        self._overlay.Toggle(op)
+        self._RefreshOverlay([op])
+
+    def ClearOverlay(self):
+        """Remove everything from the overlay."""
+        if len(self._overlay):
+            self._RefreshOverlay(self._overlay.GetOperations())
+            self._overlay.Clear()
+
+    def _RefreshOverlay(self, ops):
+        # Repaint the window where the operations draw, without marking the
+        # buffer dirty: the diagram below has not changed
+        for name, args, pen, brush, function in ops:
+            bounds = GetOperationBounds(name, args)
+            if bounds is None:
+                wx.ScrolledWindow.Refresh(self, False)
+                return
+
+            margin = 2
+            if pen:
+                margin += pen.GetWidth() * self.GetZoom()
+            left, top, right, bottom = bounds
+            x1, y1 = self.CalcDevicePosition(left, top)
+            x2, y2 = self.CalcDevicePosition(right, bottom)
+            wx.ScrolledWindow.RefreshRect(self, wx.Rect(x1 - margin, y1 - margin, x2 - x1 + 2 * margin + 1, y2 - y1 + 2 * margin + 1), False)
+
+    def _InvalidateBuffer(self, x, y, w, h):
+        # Mark a rectangle of the buffer, given in window coordinates, as
+        # needing to be rendered again. It is stored unscrolled, so that it
+        # stays valid if the window scrolls before the next paint.
+        x, y = self.CalcUnscrolledPosition(x, y)
+        self._bufferDirty.append((x, y, x + w, y + h))
+
+    def _ScrollBuffer(self, dx, dy):
+        # Shift the buffer contents by dx, dy pixels and mark the strips
+        # that were scrolled into view
+        w, h = self._buffer.GetWidth(), self._buffer.GetHeight()
+        if abs(dx) >= w or abs(dy) >= h:
+            self._InvalidateBuffer(0, 0, w, h)
+            return
+
+        if self._spareBuffer is None:
+            self._spareBuffer = wx.EmptyBitmap(w, h)
+        src = wx.MemoryDC()
+        src.SelectObject(self._buffer)
+        dst = wx.MemoryDC()
+        dst.SelectObject(self._spareBuffer)
+        dst.Blit(dx, dy, w, h, src, 0, 0)
+        dst.SelectObject(wx.NullBitmap)
+        src.SelectObject(wx.NullBitmap)
+        self._buffer, self._spareBuffer = self._spareBuffer, self._buffer
+
+        if dx > 0:
+            self._InvalidateBuffer(0, 0, dx, h)
+        elif dx < 0:
+            self._InvalidateBuffer(w + dx, 0, -dx, h)
+        if dy > 0:
+            self._InvalidateBuffer(0, 0, w, dy)
+        elif dy < 0:
+            self._InvalidateBuffer(0, h + dy, w, -dy)
+
+    def _UpdateBuffer(self):
+        # Bring the buffer up to date with the window size, scroll position
+        # and scale, and render the parts marked as dirty
+        w, h = self.GetClientSize()
+        w, h = max(w, 1), max(h, 1)
+        origin = self.CalcUnscrolledPosition(0, 0)
+        scale = self.GetScaleX(), self.GetScaleY()
+
+        if self._buffer is None or self._buffer.GetWidth() != w or self._buffer.GetHeight() != h or scale != self._bufferScale:
+            self._buffer = wx.EmptyBitmap(w, h)
+            self._spareBuffer = None
+            self._bufferDirty = [(origin[0], origin[1], origin[0] + w, origin[1] + h)]
+        elif origin != self._bufferOrigin:
+            self._ScrollBuffer(self._bufferOrigin[0] - origin[0], self._bufferOrigin[1] - origin[1])
+        self._bufferOrigin = origin
+        self._bufferScale = scale
+
+        # Shapes drawn straight onto the window, without RefreshDamage, have
+        # still recorded their changes with the diagram
+        for x, y, w, h in self._TakeDamageRects():
+            self._InvalidateBuffer(x, y, w, h)
+
+        if not self._bufferDirty:
+            return
+
+        dc = wx.MemoryDC()
+        dc.SelectObject(self._buffer)
+        background = FindOrCreateBrush(self.GetBackgroundColour(), wx.SOLID)
+        for left, top, right, bottom in MergeRects(self._bufferDirty):
+            left, top = left - origin[0], top - origin[1]
+            right, bottom = right - origin[0], bottom - origin[1]
+            left, top = max(left, 0), max(top, 0)
+            right, bottom = min(right, w), min(bottom, h)
+            if left >= right or top >= bottom:
+                continue
+
+            # Clip in window coordinates, before the DC is scrolled
+            dc.SetDeviceOrigin(0, 0)
+            dc.SetUserScale(1, 1)
+            dc.SetClippingRegion(left, top, right - left, bottom - top)
+            dc.SetBackground(background)
+            dc.Clear()
+
+            if self.GetDiagram():
+                self.PrepareDC(dc)
+                self.GetDiagram().Redraw(dc, self.CalcLogicalRect(left, top, right - left, bottom - top))
+            dc.DestroyClippingRegion()
+        dc.SelectObject(wx.NullBitmap)
+        self._bufferDirty = []
+
+    def OnEraseBackground(self, evt):
+        # The buffer covers the whole window, erasing would only flicker
+        if not self._bufferedMode:
+            evt.Skip()
+
     def OnPaint(self, evt):
         dc = wx.PaintDC(self)
+
+        if self._bufferedMode:
+            self._UpdateBuffer()
+            x, y, w, h = self.GetUpdateRegion().GetBox()
+            source = wx.MemoryDC()
+            source.SelectObject(self._buffer)
+            dc.Blit(x, y, w, h, source, x, y)
+            source.SelectObject(wx.NullBitmap)
+
+            if len(self._overlay):
+                self.PrepareDC(dc)
+                self._overlay.Draw(dc)
+            return
+
         self.PrepareDC(dc)
 
-        dc.SetBackground(wx.Brush(self.GetBackgroundColour(), wx.SOLID))
+        dc.SetBackground(FindOrCreateBrush(self.GetBackgroundColour(), wx.SOLID))
         dc.Clear()
 
         if self.GetDiagram():
-            self.GetDiagram().Redraw(dc)
+            # Drawing is clipped to the visible part of the update region
+            # anyway, so only draw the shapes inside it.
+            x, y, w, h = self.GetUpdateRegion().GetBox()
+            cw, ch = self.GetClientSize()
+            x1, y1 = max(x, 0), max(y, 0)
+            x2, y2 = min(x + w, cw), min(y + h, ch)
+            if x1 < x2 and y1 < y2:
+                self.GetDiagram().Redraw(dc, self.CalcLogicalRect(x1, y1, x2 - x1, y2 - y1))
+
+    def SetZoom(self, zoom, x = None, y = None):
+        """Set the zoom factor, the number of window pixels per diagram unit.
+
+        Zooming changes the user scale of the DC the diagram is drawn on,
+        the shapes themselves are left alone. The diagram point at window
+        position x, y, by default the centre of the window, stays in place.
+        """
+        if x is None or y is None:
+            w, h = self.GetClientSize()
+            x, y = w / 2, h / 2
+        logicalX, logicalY = self.CalcLogicalPosition(x, y)
+
+        oldZoom = self.GetZoom()
+        self.SetScale(zoom, zoom)
+
+        # The scrollable area grows and shrinks with the diagram
+        w, h = self.GetVirtualSize()
+        self.SetVirtualSize((int(w * zoom / oldZoom), int(h * zoom / oldZoom)))
+
+        ppuX, ppuY = self.GetScrollPixelsPerUnit()
+        scrollX, scrollY = -1, -1
+        if ppuX:
+            scrollX = max(int((logicalX * zoom - x) / ppuX), 0)
+        if ppuY:
+            scrollY = max(int((logicalY * zoom - y) / ppuY), 0)
+        self.Scroll(scrollX, scrollY)
+
+        self.Refresh()
+
+    def GetZoom(self):
+        """Return the zoom factor."""
+        return self.GetScaleX()
+
+    def GetHitTolerance(self):
+        """Return the distance in logical units around a shape within which
+        a click still hits it: HIT_TOLERANCE window pixels at the current
+        zoom, or HIT_TOLERANCE logical units when zoomed in.
+        """
+        return HIT_TOLERANCE / min(self.GetZoom(), 1.0)
+
+    def CalcLogicalPosition(self, x, y):
+        """Convert a position in window coordinates to logical (diagram)
+        coordinates, as a DC prepared with PrepareDC would.
+        """
+        x, y = self.CalcUnscrolledPosition(x, y)
+        scaleX, scaleY = self.GetScaleX(), self.GetScaleY()
+        if scaleX != 1 or scaleY != 1:
+            x, y = x / scaleX, y / scaleY
+        return x, y
+
+    def CalcLogicalRect(self, x, y, w, h):
+        """Convert a rectangle in window coordinates to an (x, y, width,
+        height) tuple in logical (diagram) coordinates.
+        """
+        left, top = self.CalcLogicalPosition(x, y)
+        right, bottom = self.CalcLogicalPosition(x + w, y + h)
+        return left, top, right - left, bottom - top
+
+    def GetViewRect(self):
+        """Return the part of the diagram visible in the window, as an
+        (x, y, width, height) tuple in logical coordinates.
+        """
+        w, h = self.GetClientSize()
+        return self.CalcLogicalRect(0, 0, w, h)
+
+    def CalcDevicePosition(self, x, y):
+        """Convert a position in logical (diagram) coordinates to window
+        coordinates. This is the inverse of CalcLogicalPosition.
+        """
+        x *= self.GetScaleX()
+        y *= self.GetScaleY()
+        return self.CalcScrolledPosition(int(math.floor(x)), int(math.floor(y)))
+
+    def RefreshDamage(self):
+        """Repaint the parts of the canvas where the diagram has changed
+        since the last call, see Diagram.AddDamage.
+        """
+        for rect in self._TakeDamageRects():
+            self.RefreshRect(wx.Rect(*rect), False)
+
+    def _TakeDamageRects(self):
+        # Take the diagram's damaged rectangles, as (x, y, width, height)
+        # in window coordinates
+        rects = []
+        if self.GetDiagram():
+            for left, top, right, bottom in self.GetDiagram().TakeDamage():
+                x1, y1 = self.CalcDevicePosition(left, top)
+                x2, y2 = self.CalcDevicePosition(right, bottom)
+                rects.append((x1, y1, x2 - x1 + 2, y2 - y1 + 2))
+        return rects
+
+    def SetCoalesceMotion(self, coalesce):
+        """If TRUE, motion events during a drag are not handled right away.
+        Only the newest position is passed to the drag handlers once the
+        pending events have been processed.
+        """
+        self._coalesceMotion = coalesce
+
+    def GetCoalesceMotion(self):
+        """Return TRUE if drag motion events are coalesced."""
+        return self._coalesceMotion
+
+    def ProcessPendingMotion(self):
+        """Handle the drag motion held back by motion coalescing, if any."""
+        # The canvas may have been destroyed since the call was queued
+        if not self or not self._pendingMotion:
+            return
+        x, y, keys = self._pendingMotion
+        self._pendingMotion = None
+        self.OnDragMotion(x, y, keys)
 
     def OnMouseEvent(self, evt):
-        dc = wx.ClientDC(self)
-        self.PrepareDC(dc)
+        dragging = evt.Dragging()
+
+        # Plain motion and other events without buttons are not handled,
+        # so don't bother working out the position.
+        if not dragging and not evt.IsButton():
+            return
 
-        x, y = evt.GetLogicalPosition(dc)
+        x, y = self.CalcLogicalPosition(evt.GetX(), evt.GetY())
 
         keys = 0
         if evt.ShiftDown():
@@ -87,8 +400,6 @@ class ShapeCanvas(wx.ScrolledWindow):
         if evt.ControlDown():
             keys |= KEY_CTRL
 
-        dragging = evt.Dragging()
-
         # Check if we're within the tolerance for mouse movements.
         # If we're very close to the position we started dragging
         # from, this may not be an intentional drag at all.
@@ -97,7 +408,7 @@ class ShapeCanvas(wx.ScrolledWindow):
                 # the difference between two logical coordinates is a logical coordinate
                 dx = abs(x - self._firstDragX)
                 dy = abs(y - self._firstDragY)
-                toler = self.GetDiagram().GetMouseTolerance()
+                toler = self.GetDiagram().GetMouseTolerance() / self.GetZoom()
                 if (dx <= toler) and (dy <= toler):
                     return
             # If we've ignored the tolerance once, then ALWAYS ignore
@@ -105,52 +416,25 @@ class ShapeCanvas(wx.ScrolledWindow):
             # the tolerance range.
             self._checkTolerance = False
 
-        # Dragging - note that the effect of dragging is left entirely up
-        # to the object, so no movement is done unless explicitly done by
-        # object.
-        if dragging and self._draggedShape and self._dragState == StartDraggingLeft:
-            self._dragState = ContinueDraggingLeft
-
-            # If the object isn't m_draggable, transfer message to canvas
-            dragCandidate=self._draggedShape
-            while dragCandidate and (not dragCandidate.IsSensitiveTo(OP_DRAG_LEFT)):
-                dragCandidate=dragCandidate._parent
-            if dragCandidate:
-                dragCandidate.GetEventHandler().OnBeginDragLeft(x, y, keys, self._draggedAttachment)
+            if self._coalesceMotion:
+                if not self._pendingMotion:
+                    wx.CallAfter(self.ProcessPendingMotion)
+                self._pendingMotion = x, y, keys
             else:
-                self._draggedShape = None
-                self.OnBeginDragLeft(x, y, keys)
+                self.OnDragMotion(x, y, keys)
+            return
 
-            self._oldDragX, self._oldDragY = x, y
+        # Finish any held back motion before the button changes the state
+        self.ProcessPendingMotion()
 
-        elif dragging and self._draggedShape and self._dragState == ContinueDraggingLeft:
-            # Continue dragging
-            self._draggedShape.GetEventHandler().OnDragLeft(False, self._oldDragX, self._oldDragY, keys, self._draggedAttachment)
-            self._draggedShape.GetEventHandler().OnDragLeft(True, x, y, keys, self._draggedAttachment)
-            self._oldDragX, self._oldDragY = x, y
-
-        elif evt.LeftUp() and self._draggedShape and self._dragState == ContinueDraggingLeft:
+        if evt.LeftUp() and self._draggedShape and self._dragState == ContinueDraggingLeft:
             self._dragState = NoDragging
             self._checkTolerance = True
 
             self._draggedShape.GetEventHandler().OnDragLeft(False, self._oldDragX, self._oldDragY, keys, self._draggedAttachment)
             self._draggedShape.GetEventHandler().OnEndDragLeft(x, y, keys, self._draggedAttachment)
             self._draggedShape = None
-
-        elif dragging and self._draggedShape and self._dragState == StartDraggingRight:
-            self._dragState = ContinueDraggingRight
-            if self._draggedShape.IsSensitiveTo( OP_DRAG_RIGHT ):
-                self._draggedShape.GetEventHandler().OnBeginDragRight(x, y, keys, self._draggedAttachment)
-            else:
-                self._draggedShape = None
-                self.OnBeginDragRight(x, y, keys)
-            self._oldDragX, self._oldDragY = x, y
-
-        elif dragging and self._draggedShape and self._dragState == ContinueDraggingRight:
-            # Continue dragging
-            self._draggedShape.GetEventHandler().OnDragRight(False, self._oldDragX, self._oldDragY, keys, self._draggedAttachment)
-            self._draggedShape.GetEventHandler().OnDragRight(True, x, y, keys, self._draggedAttachment)
-            self._oldDragX, self._oldDragY = x, y
+            self.ClearOverlay()
 
         elif evt.RightUp() and self._draggedShape and self._dragState == ContinueDraggingRight:
             self._dragState = NoDragging
@@ -159,18 +443,7 @@ class ShapeCanvas(wx.ScrolledWindow):
             self._draggedShape.GetEventHandler().OnDragRight(False, self._oldDragX, self._oldDragY, keys, self._draggedAttachment)
             self._draggedShape.GetEventHandler().OnEndDragRight(x, y, keys, self._draggedAttachment)
             self._draggedShape = None
-
-        # All following events sent to canvas, not object
-        elif dragging and not self._draggedShape and self._dragState == StartDraggingLeft:
-            self._dragState = ContinueDraggingLeft
-            self.OnBeginDragLeft(x, y, keys)
-            self._oldDragX, self._oldDragY = x, y
-
-        elif dragging and not self._draggedShape and self._dragState == ContinueDraggingLeft:
-            # Continue dragging
-            self.OnDragLeft(False, self._oldDragX, self._oldDragY, keys)
-            self.OnDragLeft(True, x, y, keys)
-            self._oldDragX, self._oldDragY = x, y
+            self.ClearOverlay()
 
         elif evt.LeftUp() and not self._draggedShape and self._dragState == ContinueDraggingLeft:
             self._dragState = NoDragging
@@ -179,17 +452,7 @@ class ShapeCanvas(wx.ScrolledWindow):
             self.OnDragLeft(False, self._oldDragX, self._oldDragY, keys)
             self.OnEndDragLeft(x, y, keys)
             self._draggedShape = None
-
-        elif dragging and not self._draggedShape and self._dragState == StartDraggingRight:
-            self._dragState = ContinueDraggingRight
-            self.OnBeginDragRight(x, y, keys)
-            self._oldDragX, self._oldDragY = x, y
-
-        elif dragging and not self._draggedShape and self._dragState == ContinueDraggingRight:
-            # Continue dragging
-            self.OnDragRight(False, self._oldDragX, self._oldDragY, keys)
-            self.OnDragRight(True, x, y, keys)
-            self._oldDragX, self._oldDragY = x, y
+            self.ClearOverlay()
 
         elif evt.RightUp() and not self._draggedShape and self._dragState == ContinueDraggingRight:
             self._dragState = NoDragging
@@ -198,9 +461,10 @@ class ShapeCanvas(wx.ScrolledWindow):
             self.OnDragRight(False, self._oldDragX, self._oldDragY, keys)
             self.OnEndDragRight(x, y, keys)
             self._draggedShape = None
+            self.ClearOverlay()
 
         # Non-dragging events
-        elif evt.IsButton():
+        else:
             self._checkTolerance = True
 
             # Find the nearest object
@@ -268,62 +532,164 @@ class ShapeCanvas(wx.ScrolledWindow):
                     self._draggedShape = None
                     self._dragState = NoDragging
 
+    def OnDragMotion(self, x, y, keys):
+        """Pass a drag motion to the dragged shape or to the canvas."""
+        # Dragging - note that the effect of dragging is left entirely up
+        # to the object, so no movement is done unless explicitly done by
+        # object.
+        if self._draggedShape and self._dragState == StartDraggingLeft:
+            self._dragState = ContinueDraggingLeft
+
+            # If the object isn't m_draggable, transfer message to canvas
+            dragCandidate=self._draggedShape
+            while dragCandidate and (not dragCandidate.IsSensitiveTo(OP_DRAG_LEFT)):
+                dragCandidate=dragCandidate._parent
+            if dragCandidate:
+                dragCandidate.GetEventHandler().OnBeginDragLeft(x, y, keys, self._draggedAttachment)
+            else:
+                self._draggedShape = None
+                self.OnBeginDragLeft(x, y, keys)
+
+            self._oldDragX, self._oldDragY = x, y
+
+        elif self._draggedShape and self._dragState == ContinueDraggingLeft:
+            # Continue dragging
+            self._draggedShape.GetEventHandler().OnDragLeft(False, self._oldDragX, self._oldDragY, keys, self._draggedAttachment)
+            self._draggedShape.GetEventHandler().OnDragLeft(True, x, y, keys, self._draggedAttachment)
+            self._oldDragX, self._oldDragY = x, y
+
+        elif self._draggedShape and self._dragState == StartDraggingRight:
+            self._dragState = ContinueDraggingRight
+            if self._draggedShape.IsSensitiveTo( OP_DRAG_RIGHT ):
+                self._draggedShape.GetEventHandler().OnBeginDragRight(x, y, keys, self._draggedAttachment)
+            else:
+                self._draggedShape = None
+                self.OnBeginDragRight(x, y, keys)
+            self._oldDragX, self._oldDragY = x, y
+
+        elif self._draggedShape and self._dragState == ContinueDraggingRight:
+            # Continue dragging
+            self._draggedShape.GetEventHandler().OnDragRight(False, self._oldDragX, self._oldDragY, keys, self._draggedAttachment)
+            self._draggedShape.GetEventHandler().OnDragRight(True, x, y, keys, self._draggedAttachment)
+            self._oldDragX, self._oldDragY = x, y
+
+        # All following events sent to canvas, not object
+        elif not self._draggedShape and self._dragState == StartDraggingLeft:
+            self._dragState = ContinueDraggingLeft
+            self.OnBeginDragLeft(x, y, keys)
+            self._oldDragX, self._oldDragY = x, y
+
+        elif not self._draggedShape and self._dragState == ContinueDraggingLeft:
+            # Continue dragging
+            self.OnDragLeft(False, self._oldDragX, self._oldDragY, keys)
+            self.OnDragLeft(True, x, y, keys)
+            self._oldDragX, self._oldDragY = x, y
+
+        elif not self._draggedShape and self._dragState == StartDraggingRight:
+            self._dragState = ContinueDraggingRight
+            self.OnBeginDragRight(x, y, keys)
+            self._oldDragX, self._oldDragY = x, y
+
+        elif not self._draggedShape and self._dragState == ContinueDraggingRight:
+            # Continue dragging
+            self.OnDragRight(False, self._oldDragX, self._oldDragY, keys)
+            self.OnDragRight(True, x, y, keys)
+            self._oldDragX, self._oldDragY = x, y
+
     def FindShape(self, x, y, info = None, notObject = None):
-        nearest = 100000.0
-        nearest_attachment = 0
-        nearest_object = None
+        # Only shapes whose bounds are near the point can be hit, so let
+        # the diagram's spatial index pick the candidates.
+        toler = self.GetHitTolerance()
+        rl = self.GetDiagram().QueryShapes(x - toler, y - toler, x + toler, y + toler)
 
         # Go backward through the object list, since we want:
         # (a) to have the control points drawn LAST to overlay
         #     the other objects
         # (b) to find the control points FIRST if they exist
-
-        rl = self.GetDiagram().GetShapeList()[:]
         rl.reverse()
-        for object in rl:
+
+        return self._FindShapeIn(x, y, self._FilterShapes(rl, info, notObject))
+
+    def FindShapes(self, points, info = None, notObject = None):
+        """Find the shape at each of the given (x, y) points, as FindShape
+        does, and return a list of (shape, attachment) tuples in the same
+        order as the points.
+
+        Points close to each other share one spatial index query.
+        """
+        size = DEFAULT_CELL_SIZE
+        toler = self.GetHitTolerance()
+        buckets = {}
+        for i, (x, y) in enumerate(points):
+            key = int(math.floor(x / size)), int(math.floor(y / size))
+            buckets.setdefault(key, []).append((i, x, y))
+
+        results = [None] * sum(len(bucket) for bucket in buckets.itervalues())
+        for (i, j), bucket in buckets.iteritems():
+            rl = self.GetDiagram().QueryShapes(i * size - toler, j * size - toler, (i + 1) * size + toler, (j + 1) * size + toler)
+            rl.reverse()
+            candidates = [(object, object.GetWorldBounds()) for object in self._FilterShapes(rl, info, notObject)]
+
+            for n, x, y in bucket:
+                near = [object for object, (left, top, right, bottom) in candidates
+                        if x >= left - toler and x <= right + toler and
+                           y >= top - toler and y <= bottom + toler]
+                results[n] = self._FindShapeIn(x, y, near)
+        return results
+
+    def _FilterShapes(self, shapes, info, notObject):
+        return [object for object in shapes
+                if object.IsShown() and
+                   (info == None or isinstance(object, info)) and
+                   not (notObject and notObject.HasDescendant(object))]
+
+    def _FindShapeIn(self, x, y, shapes):
+        # Shapes are given topmost first
+        nearest = 100000.0
+        nearest_attachment = 0
+        nearest_object = None
+
+        others = []
+        for object in shapes:
             # First pass for lines, which might be inside a container, so we
             # want lines to take priority over containers. This first loop
             # could fail if we clickout side a line, so then we'll
             # try other shapes.
-            if object.IsShown() and \
-               isinstance(object, LineShape) and \
-               object.HitTest(x, y) and \
-               ((info == None) or isinstance(object, info)) and \
-               (not notObject or not notObject.HasDescendant(object)):
-                temp_attachment, dist = object.HitTest(x, y)
-                # A line is trickier to spot than a normal object.
-                # For a line, since it's the diagonal of the box
-                # we use for the hit test, we may have several
-                # lines in the box and therefore we need to be able
-                # to specify the nearest point to the centre of the line
-                # as our hit criterion, to give the user some room for
-                # manouevre.
-                if dist < nearest:
-                    nearest = dist
-                    nearest_object = object
-                    nearest_attachment = temp_attachment
+            if isinstance(object, LineShape):
+                hit = object.HitTest(x, y)
+                if hit:
+                    temp_attachment, dist = hit
+                    # A line is trickier to spot than a normal object.
+                    # For a line, since it's the diagonal of the box
+                    # we use for the hit test, we may have several
+                    # lines in the box and therefore we need to be able
+                    # to specify the nearest point to the centre of the line
+                    # as our hit criterion, to give the user some room for
+                    # manouevre.
+                    if dist < nearest:
+                        nearest = dist
+                        nearest_object = object
+                        nearest_attachment = temp_attachment
 
-        for object in rl:
             # On second pass, only ever consider non-composites or
             # divisions. If children want to pass up control to
             # the composite, that's up to them.
-            if (object.IsShown() and
-                   (isinstance(object, DivisionShape) or
-                    not isinstance(object, CompositeShape)) and
-                    object.HitTest(x, y) and
-                    (info == None or isinstance(object, info)) and
-                    (not notObject or not notObject.HasDescendant(object))):
-                temp_attachment, dist = object.HitTest(x, y)
-                if not isinstance(object, LineShape):
-                    # If we've hit a container, and we have already
-                    # found a line in the first pass, then ignore
-                    # the container in case the line is in the container.
-                    # Check for division in case line straddles divisions
-                    # (i.e. is not wholly contained).
-                    if not nearest_object or not (isinstance(object, DivisionShape) or WhollyContains(object, nearest_object)):
-                        nearest_object = object
-                        nearest_attachment = temp_attachment
-                        break
+            elif isinstance(object, DivisionShape) or not isinstance(object, CompositeShape):
+                others.append(object)
+
+        for object in others:
+            hit = object.HitTest(x, y)
+            if hit:
+                temp_attachment, dist = hit
+                # If we've hit a container, and we have already
+                # found a line in the first pass, then ignore
+                # the container in case the line is in the container.
+                # Check for division in case line straddles divisions
+                # (i.e. is not wholly contained).
+                if not nearest_object or not (isinstance(object, DivisionShape) or WhollyContains(object, nearest_object)):
+                    nearest_object = object
+                    nearest_attachment = temp_attachment
+                    break
 
         return nearest_object, nearest_attachment
 
@@ -340,6 +706,8 @@ class ShapeCanvas(wx.ScrolledWindow):
         return self.GetDiagram().GetQuickEditMode()
 
     def Redraw(self, dc):
+        # Draws everything, dc may be a printer or bitmap DC used for export.
+        # Painting culls to the visible part in OnPaint instead.
         self.GetDiagram().Redraw(dc)
 
     def Snap(self, x, y):
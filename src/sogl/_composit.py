@@ -404,7 +404,7 @@ class CompositeShape(RectangleShape):
         if self._shadowMode != SHADOW_NONE:
             if self._shadowBrush:
                 dc.SetBrush(self._shadowBrush)
-            dc.SetPen(wx.Pen(wx.WHITE, 1, wx.TRANSPARENT))
+            dc.SetPen(FindOrCreatePen(wx.WHITE, 1, wx.TRANSPARENT))
 
             if self._cornerRadius:
                 dc.DrawRoundedRectangle(x1 + self._shadowOffsetX, y1 + self._shadowOffsetY, self._width, self._height, self._cornerRadius)
@@ -441,11 +441,9 @@ class CompositeShape(RectangleShape):
         offsetX = xx - _objectStartX
         offsetY = yy - _objectStartY
 
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dc.SetLogicalFunction(OGLRBLF)
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -457,13 +455,11 @@ class CompositeShape(RectangleShape):
         _objectStartX = x
         _objectStartY = y
 
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        dc = self.GetCanvas().GetOverlayDC()
 
         #self.Erase(dc)
 
-        dc.SetLogicalFunction(OGLRBLF)
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
         self._canvas.CaptureMouse()
@@ -497,7 +493,7 @@ class CompositeShape(RectangleShape):
         self.Move(dc, self.GetX() + offsetX, self.GetY() + offsetY)
 
         if self._canvas and not self._canvas.GetQuickEditMode():
-            self._canvas.Redraw(dc)
+            self._canvas.RefreshDamage()
 
     def OnRightClick(self, x, y, keys = 0, attachment = 0):
         # If we get a ctrl-right click, this means send the message to
@@ -518,6 +514,7 @@ class CompositeShape(RectangleShape):
 
         self._width = w
         self._height = h
+        self.InvalidateBounds()
 
         if not recursive:
             return
@@ -576,6 +573,8 @@ class CompositeShape(RectangleShape):
             self.RemoveChild(child)
             child.Delete()
         RectangleShape.Delete(self)
+        for constraint in self._constraints:
+            self._UnregisterConstraint(constraint)
         self._constraints = []
         self._divisions = []
 
@@ -584,12 +583,12 @@ class CompositeShape(RectangleShape):
 
         Used when deleting a child from the composite.
         """
-        for constraint in self._constraints:
+        for constraint in self._constraints[:]:
             if constraint._constrainingObject == child or child in constraint._constrainedObjects:
-                self._constraints.remove(constraint)
+                self.DeleteConstraint(constraint)
 
     def RemoveChildFromConstraints(self, child):
-        for constraint in self._constraints:
+        for constraint in self._constraints[:]:
             if child in constraint._constrainedObjects:
                 constraint._constrainedObjects.remove(child)
             if constraint._constrainingObject == child:
@@ -597,13 +596,14 @@ class CompositeShape(RectangleShape):
 
             # Delete the constraint if no participants left
             if not constraint._constrainingObject:
-                self._constraints.remove(constraint)
+                self.DeleteConstraint(constraint)
 
     def AddConstraint(self, constraint):
         """Adds a constraint to the composite."""
         self._constraints.append(constraint)
         if constraint._constraintId == 0:
             constraint._constraintId = wx.NewId()
+        self._RegisterConstraint(constraint)
         return constraint
 
     def AddSimpleConstraint(self, type, constraining, constrained):
@@ -616,6 +616,7 @@ class CompositeShape(RectangleShape):
         if constraint._constraintId == 0:
             constraint._constraintId = wx.NewId()
         self._constraints.append(constraint)
+        self._RegisterConstraint(constraint)
         return constraint
 
     def FindConstraint(self, cId):
@@ -627,6 +628,20 @@ class CompositeShape(RectangleShape):
 
         Returns None if not found.
         """
+        # Look the id up in the diagram if this composite is part of one.
+        # Descendant composites that are not in the diagram themselves are
+        # not in its table, so fall back to searching on a miss.
+        diagram = self._canvas and self._canvas.GetDiagram()
+        if diagram and diagram.HasShape(self):
+            found = diagram.FindConstraint(cId)
+            if found:
+                # Only constraints of this composite or its descendants
+                composite = found[1]
+                while composite and composite != self:
+                    composite = composite.GetParent()
+                if composite:
+                    return found
+
         for constraint in self._constraints:
             if constraint._constraintId == cId:
                 return constraint, self
@@ -643,6 +658,15 @@ class CompositeShape(RectangleShape):
     def DeleteConstraint(self, constraint):
         """Deletes constraint from composite."""
         self._constraints.remove(constraint)
+        self._UnregisterConstraint(constraint)
+
+    def _RegisterConstraint(self, constraint):
+        if self._canvas and self._canvas.GetDiagram():
+            self._canvas.GetDiagram().RegisterConstraint(constraint, self)
+
+    def _UnregisterConstraint(self, constraint):
+        if self._canvas and self._canvas.GetDiagram():
+            self._canvas.GetDiagram().UnregisterConstraint(constraint)
 
     def CalculateSize(self):
         """Calculates the size and position of the composite based on
@@ -659,26 +683,34 @@ class CompositeShape(RectangleShape):
             if isinstance(child, CompositeShape):
                 child.CalculateSize()
 
-            w, h = child.GetBoundingBoxMax()
-            if child.GetX() + w / 2.0 > maxX:
-                maxX = child.GetX() + w / 2.0
-            if child.GetX() - w / 2.0 < minX:
-                minX = child.GetX() - w / 2.0
-            if child.GetY() + h / 2.0 > maxY:
-                maxY = child.GetY() + h / 2.0
-            if child.GetY() - h / 2.0 < minY:
-                minY = child.GetY() - h / 2.0
+            left, top, right, bottom = child.GetWorldBounds()
+            if right > maxX:
+                maxX = right
+            if left < minX:
+                minX = left
+            if bottom > maxY:
+                maxY = bottom
+            if top < minY:
+                minY = top
 
         self._width = maxX - minX
         self._height = maxY - minY
         self._xpos = self._width / 2.0 + minX
         self._ypos = self._height / 2.0 + minY
+        self.InvalidateBounds()
 
     def Recompute(self):
         """Recomputes any constraints associated with the object. If FALSE is
         returned, the constraints could not be satisfied (there was an
         inconsistency).
+
+        Inside Diagram.BatchUpdate the constraints are recomputed when the
+        batch ends, and TRUE is returned.
         """
+        batch = self.GetBatchDiagram()
+        if batch and batch.DeferRecompute(self):
+            return True
+
         noIterations = 0
         changed = True
         while changed and noIterations < 500:
@@ -1084,6 +1116,7 @@ class DivisionShape(CompositeShape):
         dc.SetLogicalFunction(wx.COPY)
 
         self._xpos, self._ypos = self._canvas.Snap(self._xpos, self._ypos)
+        self.InvalidateBounds()
         self.GetEventHandler().OnMovePre(dc, x, y, self._oldX, self._oldY)
 
         self.ResetControlPoints()
@@ -1092,7 +1125,7 @@ class DivisionShape(CompositeShape):
         self.GetEventHandler().OnDrawControlPoints(dc)
 
         if self._canvas and not self._canvas.GetQuickEditMode():
-            self._canvas.Redraw(dc)
+            self._canvas.RefreshDamage()
 
     def SetSize(self, w, h, recursive = True):
         self._width = w
@@ -11,12 +11,153 @@
 # Licence:      wxWindows license
 #----------------------------------------------------------------------------
 
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import wx
 
+from _spatial import SpatialIndex, MergeRects
+from _statedc import StateTrackingDC
+from _sprite import TheSpriteCache
+from _soglmisc import RECT_INTERSECTS, RECT_CONTAINS, DAMAGE_MARGIN, MAX_DAMAGE_RECTS, DRAW_LAST_POINT, FindOrCreatePen
+from _soglmisc import GREEK_TEXT_SIZE, MIN_DETAIL_SIZE, MIN_SHAPE_SIZE
+
 DEFAULT_MOUSE_TOLERANCE = 3
 
 
 
+class ShapeList(object):
+    """An ordered set of shapes, used as the diagram's drawing order.
+
+    The shapes are kept in a doubly linked list, and each shape has an
+    integer key that increases along the list. Membership tests, appending,
+    prepending, removal and comparing the positions of two shapes take
+    constant time. Inserting in the middle takes constant time until the
+    keys around the insertion point run out, after about 16 insertions at
+    the same place; then the whole list is renumbered, which takes linear
+    time.
+    """
+    # Distance between neighbouring keys after renumbering
+    KEY_SPACING = 1 << 16
+
+    def __init__(self, shapes = ()):
+        self._next = {}
+        self._prev = {}
+        self._keys = {}
+        self._first = None
+        self._last = None
+        self._tuple = None
+        for shape in shapes:
+            self.Append(shape)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, shape):
+        return shape in self._keys
+
+    def __iter__(self):
+        return iter(self.AsTuple())
+
+    def __reversed__(self):
+        return reversed(self.AsTuple())
+
+    def AsTuple(self):
+        """Return the shapes as a tuple, which is cached until the list
+        changes.
+        """
+        if self._tuple is None:
+            shapes = []
+            shape = self._first
+            while shape is not None:
+                shapes.append(shape)
+                shape = self._next[shape]
+            self._tuple = tuple(shapes)
+        return self._tuple
+
+    def GetKey(self, shape):
+        """Return the order key of the shape. Keys of shapes earlier in the
+        list are smaller.
+        """
+        return self._keys[shape]
+
+    def _Link(self, shape, prev, next, key):
+        self._keys[shape] = key
+        self._prev[shape] = prev
+        self._next[shape] = next
+        if prev is None:
+            self._first = shape
+        else:
+            self._next[prev] = shape
+        if next is None:
+            self._last = shape
+        else:
+            self._prev[next] = shape
+        self._tuple = None
+
+    def _Renumber(self):
+        key = 0
+        shape = self._first
+        while shape is not None:
+            self._keys[shape] = key
+            key += self.KEY_SPACING
+            shape = self._next[shape]
+
+    def Append(self, shape):
+        """Add the shape at the end of the list."""
+        if self._last is None:
+            key = 0
+        else:
+            key = self._keys[self._last] + self.KEY_SPACING
+        self._Link(shape, self._last, None, key)
+
+    def Prepend(self, shape):
+        """Add the shape at the start of the list."""
+        if self._first is None:
+            key = 0
+        else:
+            key = self._keys[self._first] - self.KEY_SPACING
+        self._Link(shape, None, self._first, key)
+
+    def InsertAfter(self, shape, after):
+        """Add the shape directly after the shape after, which must be in
+        the list. May renumber the list, see the class description.
+        """
+        next = self._next[after]
+        if next is None:
+            self.Append(shape)
+            return
+
+        if self._keys[next] - self._keys[after] < 2:
+            # No free key left between the two
+            self._Renumber()
+        self._Link(shape, after, next, (self._keys[after] + self._keys[next]) // 2)
+
+    def Remove(self, shape):
+        """Remove the shape from the list. Does nothing if it is not in
+        the list.
+        """
+        if shape not in self._keys:
+            return
+        prev = self._prev.pop(shape)
+        next = self._next.pop(shape)
+        del self._keys[shape]
+        if prev is None:
+            self._first = next
+        else:
+            self._next[prev] = next
+        if next is None:
+            self._last = prev
+        else:
+            self._prev[next] = prev
+        self._tuple = None
+
+    def Clear(self):
+        """Remove all shapes from the list."""
+        self.__init__()
+
+
+
 class Diagram(object):
     """Encapsulates an entire diagram, with methods for drawing. A diagram has
     an associated ShapeCanvas.
@@ -29,19 +170,88 @@ class Diagram(object):
         self._quickEditMode = False
         self._snapToGrid = True
         self._gridSpacing = 5.0
-        self._shapeList = []
+        self._shapeList = ShapeList()
         self._mouseTolerance = DEFAULT_MOUSE_TOLERANCE
 
-    def Redraw(self, dc):
-        """Draw the shapes in the diagram on the specified device context."""
+        # Spatial index over the shape bounds. Shapes whose geometry has
+        # changed are collected and re-entered lazily before each query.
+        self._shapeIndex = SpatialIndex()
+        self._staleShapes = set()
+
+        # Lookup tables for FindShape and FindConstraint
+        self._shapesById = {}
+        self._constraintsById = {}
+
+        # Rectangles that need repainting since the last TakeDamage
+        self._damage = []
+
+        # Drop redundant pen, brush etc. changes while redrawing, see
+        # SetTrackDCState
+        self._trackDCState = False
+
+        # Level of detail thresholds in screen pixels
+        self._detailThresholds = GREEK_TEXT_SIZE, MIN_DETAIL_SIZE, MIN_SHAPE_SIZE
+
+        # Work put off until the end of a batch update, see BatchUpdate
+        self._batchDepth = 0
+        self._batchFlushing = False
+        self._batchLines = OrderedDict()
+        self._batchComposites = OrderedDict()
+
+    def Redraw(self, dc, rect = None):
+        """Draw the shapes in the diagram on the specified device context.
+
+        If rect, a wx.Rect or an (x, y, width, height) tuple, is given only
+        the shapes near that part of the diagram are drawn.
+        """
         if self._shapeList:
-            if self.GetCanvas():
+            if self._trackDCState and not isinstance(dc, StateTrackingDC):
+                dc = StateTrackingDC(dc)
+
+            if rect is None:
+                shapes = self._shapeList
+            else:
+                x, y, w, h = rect
+                shapes = self.QueryShapes(x - DAMAGE_MARGIN, y - DAMAGE_MARGIN, x + w + DAMAGE_MARGIN, y + h + DAMAGE_MARGIN)
+
+            # Partial redraws are part of painting and should be quick,
+            # only show the busy cursor when drawing everything
+            busy = rect is None and self.GetCanvas()
+            if busy:
                 self.GetCanvas().SetCursor(wx.HOURGLASS_CURSOR)
-            for object in self._shapeList:
-                object.Draw(dc)
-            if self.GetCanvas():
+            # Runs of straight lines with the same pen are drawn with one
+            # DrawLineList call. Only consecutive lines are batched, so the
+            # drawing order is kept.
+            batchPen = None
+            batch = []
+            for object in shapes:
+                line = object.GetBatchLine()
+                if line is None:
+                    if batch:
+                        self._DrawLineBatch(dc, batchPen, batch)
+                        batch = []
+                    object.Draw(dc)
+                else:
+                    pen, segment = line
+                    if batch and pen != batchPen:
+                        self._DrawLineBatch(dc, batchPen, batch)
+                        batch = []
+                    batchPen = pen
+                    batch.append(segment)
+            if batch:
+                self._DrawLineBatch(dc, batchPen, batch)
+            if busy:
                 self.GetCanvas().SetCursor(wx.STANDARD_CURSOR)
 
+    def _DrawLineBatch(self, dc, pen, segments):
+        dc.SetPen(pen)
+        if len(segments) == 1:
+            dc.DrawLine(*segments[0])
+        else:
+            dc.DrawLineList(segments)
+        if DRAW_LAST_POINT:
+            dc.DrawPointList([(x2, y2) for x1, y1, x2, y2 in segments])
+
     def Clear(self, dc):
         """Clear the specified device context."""
         dc.Clear()
@@ -52,30 +262,379 @@ class Diagram(object):
         """
         if not object in self._shapeList:
             if addAfter:
-                self._shapeList.insert(self._shapeList.index(addAfter) + 1, object)
+                self._shapeList.InsertAfter(object, addAfter)
             else:
-                self._shapeList.append(object)
+                self._shapeList.Append(object)
 
             object.SetCanvas(self.GetCanvas())
+            self._IndexShape(object)
 
     def InsertShape(self, object):
         """Insert a shape at the front of the shape list."""
-        self._shapeList.insert(0, object)
+        if not object in self._shapeList:
+            self._shapeList.Prepend(object)
+            self._IndexShape(object)
 
     def RemoveShape(self, object):
         """Remove the shape from the diagram (non-recursively) but do not
         delete it.
         """
         if object in self._shapeList:
-            self._shapeList.remove(object)
+            self.AddDamage(*self._shapeIndex.GetBounds(object))
+            if object in self._staleShapes:
+                self.AddDamage(*object.GetWorldBounds())
+
+            self._shapeList.Remove(object)
+            self._shapeIndex.Remove(object)
+            self._staleShapes.discard(object)
+            self._UnregisterShape(object)
+
+            # Do not keep removed shapes alive through the sprite cache
+            TheSpriteCache.Discard(object)
 
     def RemoveAllShapes(self):
         """Remove all shapes from the diagram but do not delete the shapes."""
-        self._shapeList = []
+        self._UpdateShapeIndex()
+        for shape in self._shapeList:
+            self.AddDamage(*self._shapeIndex.GetBounds(shape))
+            TheSpriteCache.Discard(shape)
+
+        self._shapeList.Clear()
+        self._shapeIndex.Clear()
+        self._staleShapes = set()
+        self._shapesById = {}
+        self._constraintsById = {}
+
+    def _IndexShape(self, shape):
+        self._shapeIndex.Insert(shape, shape.GetWorldBounds())
+        self._staleShapes.discard(shape)
+        self.AddDamage(*shape.GetWorldBounds())
+
+        self._shapesById.setdefault(shape.GetId(), set()).add(shape)
+        if hasattr(shape, "GetConstraints"):
+            for constraint in shape.GetConstraints():
+                self._constraintsById[constraint._constraintId] = constraint, shape
+
+    def _UnregisterShape(self, shape):
+        shapes = self._shapesById.get(shape.GetId())
+        if shapes is not None:
+            shapes.discard(shape)
+            if not shapes:
+                del self._shapesById[shape.GetId()]
+        if hasattr(shape, "GetConstraints"):
+            for constraint in shape.GetConstraints():
+                self.UnregisterConstraint(constraint)
+
+    def ShapeIdChanged(self, shape, oldId):
+        """Update the id lookup table after the id of shape has changed
+        from oldId. Called by Shape.SetId.
+        """
+        shapes = self._shapesById.get(oldId)
+        if shapes is None or shape not in shapes:
+            return
+        shapes.discard(shape)
+        if not shapes:
+            del self._shapesById[oldId]
+        self._shapesById.setdefault(shape.GetId(), set()).add(shape)
+
+    def RegisterConstraint(self, constraint, composite):
+        """Enter the constraint of the given composite into the constraint
+        lookup table. Does nothing if the composite is not in the diagram.
+        """
+        if self.HasShape(composite):
+            self._constraintsById[constraint._constraintId] = constraint, composite
+
+    def UnregisterConstraint(self, constraint):
+        """Remove the constraint from the constraint lookup table."""
+        entry = self._constraintsById.get(constraint._constraintId)
+        if entry is not None and entry[0] is constraint:
+            del self._constraintsById[constraint._constraintId]
+
+    def FindConstraint(self, cId):
+        """Return a tuple of the constraint with the given id and the
+        composite it belongs to, or None if not found.
+        """
+        return self._constraintsById.get(cId)
+
+    def InvalidateShapeBounds(self, shape):
+        """Mark the index entry of the shape as out of date.
+
+        Called by the shape whenever its geometry changes; the index is
+        brought up to date before the next query.
+        """
+        self._staleShapes.add(shape)
+
+    def _UpdateShapeIndex(self):
+        if not self._staleShapes:
+            return
+        index = self._shapeIndex
+        for shape in self._staleShapes:
+            if shape in index:
+                # The shape has to be repainted where it was and where it is
+                old = index.GetBounds(shape)
+                new = shape.GetWorldBounds()
+                self.AddDamage(*old)
+                if new != old:
+                    self.AddDamage(*new)
+                index.Update(shape, new)
+        self._staleShapes = set()
+
+    def AddDamage(self, left, top, right, bottom):
+        """Mark the given rectangle of the diagram as needing repainting.
+
+        Changes to shapes added to the diagram are recorded automatically.
+        """
+        self._damage.append((left - DAMAGE_MARGIN, top - DAMAGE_MARGIN, right + DAMAGE_MARGIN, bottom + DAMAGE_MARGIN))
+        if len(self._damage) > MAX_DAMAGE_RECTS:
+            self._damage = MergeRects(self._damage)
+            if len(self._damage) > MAX_DAMAGE_RECTS // 2:
+                # Scattered changes, just repaint everything they span
+                self._damage = [(min(r[0] for r in self._damage), min(r[1] for r in self._damage),
+                                 max(r[2] for r in self._damage), max(r[3] for r in self._damage))]
+
+    def TakeDamage(self):
+        """Return the list of (left, top, right, bottom) rectangles that
+        need repainting since the last call, and forget them.
+        """
+        self._UpdateShapeIndex()
+        damage = MergeRects(self._damage)
+        self._damage = []
+        return damage
+
+    def BeginBatchUpdate(self):
+        """Start a batch update, see BatchUpdate. Calls may be nested and
+        must be matched by EndBatchUpdate.
+        """
+        self._batchDepth += 1
+
+    def EndBatchUpdate(self):
+        """End a batch update. When the outermost batch ends, the deferred
+        constraints and lines are recomputed and the changed parts of the
+        canvas are refreshed. Does nothing outside a batch update.
+        """
+        if self._batchDepth == 0:
+            return
+        if self._batchDepth > 1:
+            self._batchDepth -= 1
+            return
+
+        # Drawing stays suspended while catching up, and link moves caused
+        # by the constraints are still collected
+        canvas = self.GetCanvas()
+        self._batchFlushing = True
+        try:
+            while self._batchComposites:
+                composites = self._batchComposites.keys()
+                self._batchComposites.clear()
+                for composite in composites:
+                    composite.Recompute()
+
+            if self._batchLines and canvas:
+                dc = wx.ClientDC(canvas)
+                canvas.PrepareDC(dc)
+                while self._batchLines:
+                    line, dummy = self._batchLines.popitem(last = False)
+                    line.GetEventHandler().OnMoveLink(dc)
+            self._batchLines.clear()
+        finally:
+            self._batchFlushing = False
+            self._batchDepth = 0
+
+        if canvas and not self._quickEditMode:
+            canvas.RefreshDamage()
+
+    @contextmanager
+    def BatchUpdate(self):
+        """Context manager for changing many shapes at once:
+
+            with diagram.BatchUpdate():
+                for shape in shapes:
+                    shape.Move(dc, shape.GetX() + 10, shape.GetY())
+
+        Inside it, moved and erased shapes are not drawn, attached lines are
+        not moved and composites do not recompute their constraints. On
+        leaving it each affected composite and line is recomputed once and
+        the changed parts of the canvas are repainted.
+        """
+        self.BeginBatchUpdate()
+        try:
+            yield self
+        finally:
+            self.EndBatchUpdate()
+
+    def IsBatchUpdating(self):
+        """TRUE inside BatchUpdate."""
+        return self._batchDepth > 0
+
+    def DeferLinkMoves(self, lines):
+        """Remember lines to be moved at the end of the batch update."""
+        for line in lines:
+            self._batchLines[line] = None
+
+    def DeferRecompute(self, composite):
+        """Remember a composite whose constraints are to be recomputed at the
+        end of the batch update. Returns FALSE if that is already happening,
+        in which case the composite should recompute now.
+        """
+        if self._batchFlushing:
+            return False
+        self._batchComposites[composite] = None
+        return True
+
+    def _GetMoveSets(self, shapes):
+        # Split a selection into the shapes to move (leaving out children of
+        # selected composites, which move with their parent) and the lines
+        # running between moved shapes, which move along as a whole
+        selected = set(shapes)
+        moved = set()
+        for shape in shapes:
+            stack = [shape]
+            while stack:
+                child = stack.pop()
+                moved.add(child)
+                stack.extend(child.GetChildren())
+
+        internal = OrderedDict()
+        for shape in moved:
+            for line in shape.GetLines():
+                if line.GetFrom() in moved and line.GetTo() in moved:
+                    internal[line] = None
+
+        roots = []
+        for shape in shapes:
+            if shape in internal:
+                continue
+            parent = shape.GetParent()
+            while parent and parent not in selected:
+                parent = parent.GetParent()
+            if not parent:
+                roots.append(shape)
+        return roots, internal.keys()
+
+    def _GetMoveDC(self):
+        canvas = self.GetCanvas()
+        if not canvas:
+            return None
+        dc = wx.ClientDC(canvas)
+        canvas.PrepareDC(dc)
+        return dc
+
+    def _MoveRoot(self, dc, shape, x, y):
+        shape.Move(dc, x, y)
+        # A selected line moves all its control points, so its ends have
+        # to be put back on its shapes even if they did not move
+        if hasattr(shape, "GetFrom"):
+            self.DeferLinkMoves([shape])
+
+    def MoveShapes(self, shapes, dx, dy):
+        """Move the given shapes by dx, dy in one go.
+
+        Children of selected composites move with their parent. Lines with
+        both ends among the moved shapes are moved as they are, control
+        points and labels included; only lines with one end outside the
+        selection are reattached. The canvas is repainted once at the end.
+
+        Does nothing if the diagram has no canvas.
+        """
+        dc = self._GetMoveDC()
+        if dc is None:
+            return
+        roots, internal = self._GetMoveSets(shapes)
+
+        with self.BatchUpdate():
+            for shape in roots:
+                self._MoveRoot(dc, shape, shape.GetX() + dx, shape.GetY() + dy)
+            for line in internal:
+                self._batchLines.pop(line, None)
+                line.Move(dc, line.GetX() + dx, line.GetY() + dy)
+
+    def TransformShapes(self, shapes, matrix):
+        """Move the given shapes by an affine transformation, given as the
+        two rows ((a, b, tx), (c, d, ty)) of the matrix mapping x, y to
+        a * x + b * y + tx, c * x + d * y + ty.
+
+        Each shape is moved so that its centre lands on the transformed
+        centre; the shapes themselves keep their size and orientation.
+        Control points between the ends of lines inside the selection are
+        transformed too, the line ends are reattached once at the end.
+
+        Does nothing if the diagram has no canvas.
+        """
+        (a, b, tx), (c, d, ty) = matrix[:2]
+        dc = self._GetMoveDC()
+        if dc is None:
+            return
+        roots, internal = self._GetMoveSets(shapes)
+
+        with self.BatchUpdate():
+            for shape in roots:
+                x, y = shape.GetX(), shape.GetY()
+                self._MoveRoot(dc, shape, a * x + b * y + tx, c * x + d * y + ty)
+            for line in internal:
+                for point in line.GetLineControlPoints()[1:-1]:
+                    x, y = point[0], point[1]
+                    point[0] = a * x + b * y + tx
+                    point[1] = c * x + d * y + ty
+                # Moving on the spot brings the label rectangles along
+                line.Move(dc, line.GetX(), line.GetY())
+                self.DeferLinkMoves([line])
+
+    def QueryShapes(self, left, top, right, bottom):
+        """Return the shapes whose bounds intersect the given rectangle,
+        in drawing order (the same order as the shape list).
+        """
+        self._UpdateShapeIndex()
+        found = self._shapeIndex.Query(left, top, right, bottom)
+
+        return sorted(found, key = self._shapeList.GetKey)
+
+    def FindShapesInRect(self, rect, mode = RECT_INTERSECTS, types = None):
+        """Return the visible shapes lying in the rectangle rect, given as a
+        wx.Rect or an (x, y, width, height) tuple, in drawing order.
+
+        mode is RECT_INTERSECTS to return shapes touching the rectangle, or
+        RECT_CONTAINS to return only shapes wholly inside it. If types is
+        given (a class or tuple of classes), only instances of those are
+        returned.
+        """
+        x, y, w, h = rect
+        # Allow rectangles dragged out in any direction
+        left, right = min(x, x + w), max(x, x + w)
+        top, bottom = min(y, y + h), max(y, y + h)
+
+        found = []
+        for shape in self.QueryShapes(left, top, right, bottom):
+            if not shape.IsShown():
+                continue
+            if types is not None and not isinstance(shape, types):
+                continue
+            if mode == RECT_CONTAINS:
+                l, t, r, b = shape.GetWorldBounds()
+                if l < left or t < top or r > right or b > bottom:
+                    continue
+            found.append(shape)
+        return found
+
+    def FindShapesNear(self, x, y, radius):
+        """Return the visible shapes whose bounds lie within radius of the
+        point x, y, nearest first.
+        """
+        found = []
+        for shape in self.QueryShapes(x - radius, y - radius, x + radius, y + radius):
+            if not shape.IsShown():
+                continue
+            l, t, r, b = shape.GetWorldBounds()
+            dx = max(l - x, 0, x - r)
+            dy = max(t - y, 0, y - b)
+            dist = dx * dx + dy * dy
+            if dist <= radius * radius:
+                found.append((dist, len(found), shape))
+        found.sort()
+        return [shape for dist, i, shape in found]
 
     def DeleteAllShapes(self):
         """Remove and delete all shapes in the diagram."""
-        for shape in self._shapeList[:]:
+        for shape in self._shapeList.AsTuple():
             if not shape.GetParent():
                 self.RemoveShape(shape)
                 shape.Delete()
@@ -87,7 +646,7 @@ class Diagram(object):
 
     def DrawOutline(self, dc, x1, y1, x2, y2):
         """Draw an outline rectangle on the current device context."""
-        dc.SetPen(wx.Pen(wx.Color(0, 0, 0), 1, wx.DOT))
+        dc.SetPen(FindOrCreatePen(wx.BLACK, 1, wx.DOT))
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
         dc.DrawLines([[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]])
@@ -107,10 +666,15 @@ class Diagram(object):
 
     def FindShape(self, id):
         """Return the shape for the given identifier."""
-        for shape in self._shapeList:
-            if shape.GetId() == id:
+        shapes = self._shapesById.get(id)
+        if not shapes:
+            return None
+        if len(shapes) == 1:
+            for shape in shapes:
                 return shape
-        return None
+
+        # Several shapes share the id, return the first in the list
+        return min(shapes, key = self._shapeList.GetKey)
 
     def Snap(self, x, y):
         """'Snaps' the coordinate to the nearest grid position, if
@@ -147,6 +711,19 @@ class Diagram(object):
         """Return quick edit mode."""
         return self._quickEditMode
 
+    def SetTrackDCState(self, track):
+        """Set whether Redraw wraps the device context in a StateTrackingDC.
+
+        This is off by default. Only turn it on if no OnDraw handler needs
+        a real wx.DC, and pens, brushes and fonts are not changed in place
+        between drawing shapes: the wrapper compares them by identity.
+        """
+        self._trackDCState = track
+
+    def GetTrackDCState(self):
+        """Return whether Redraw tracks the device context state."""
+        return self._trackDCState
+
     def SetMouseTolerance(self, tolerance):
         """Set the tolerance within which a mouse move is ignored.
 
@@ -158,9 +735,52 @@ class Diagram(object):
         """Return the tolerance within which a mouse move is ignored."""
         return self._mouseTolerance
 
+    def SetDetailThresholds(self, greekTextSize, minDetailSize, minShapeSize):
+        """Set the level of detail thresholds, in screen pixels.
+
+        Text in fonts smaller than greekTextSize is drawn as bars,
+        arrowheads, shadows and branches smaller than minDetailSize are
+        left out, and shapes smaller than minShapeSize are drawn as plain
+        rectangles. A threshold of 0 turns that simplification off.
+        """
+        self._detailThresholds = greekTextSize, minDetailSize, minShapeSize
+
+    def GetDetailThresholds(self):
+        """Return the level of detail thresholds as a (greekTextSize,
+        minDetailSize, minShapeSize) tuple.
+        """
+        return self._detailThresholds
+
+    def HasShape(self, shape):
+        """TRUE if the shape is in the diagram."""
+        return shape in self._shapeList
+
+    def BringToFront(self, shape):
+        """Move the shape to the end of the shape list, so that it is drawn
+        on top of all other shapes.
+        """
+        if shape in self._shapeList:
+            self._shapeList.Remove(shape)
+            self._shapeList.Append(shape)
+            self.AddDamage(*shape.GetWorldBounds())
+
+    def SendToBack(self, shape):
+        """Move the shape to the start of the shape list, so that it is
+        drawn below all other shapes.
+        """
+        if shape in self._shapeList:
+            self._shapeList.Remove(shape)
+            self._shapeList.Prepend(shape)
+            self.AddDamage(*shape.GetWorldBounds())
+
     def GetShapeList(self):
-        """Return the internal shape list."""
-        return self._shapeList
+        """Return a list of the shapes of the diagram in drawing order.
+
+        The list is a copy: changing it does not change the diagram. Use
+        AddShape, InsertShape, RemoveShape, BringToFront and SendToBack
+        for that.
+        """
+        return list(self._shapeList.AsTuple())
 
     def GetCount(self):
         """Return the number of shapes in the diagram."""
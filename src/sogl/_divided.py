@@ -26,11 +26,9 @@ class DividedShapeControlPoint(ControlPoint):
 
     # Implement resizing of divided object division
     def OnDragLeft(self, draw, x, y, keys = 0, attachment = 0):
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dc.SetLogicalFunction(OGLRBLF)
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -43,11 +41,9 @@ class DividedShapeControlPoint(ControlPoint):
         dc.DrawLine(x1, y1, x2, y2)
 
     def OnBeginDragLeft(self, x, y, keys = 0, attachment = 0):
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dc.SetLogicalFunction(OGLRBLF)
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -192,7 +188,7 @@ class DividedShape(RectangleShape):
             centreX = self._xpos
             centreY = currentY + (actualY - currentY) / 2.0
 
-            DrawFormattedText(dc, region._formattedText, centreX, centreY, self._width - 2 * xMargin, actualY - currentY - 2 * yMargin, region._formatMode)
+            DrawFormattedText(dc, region._formattedText, centreX, centreY, self._width - 2 * xMargin, actualY - currentY - 2 * yMargin, region._formatMode, self.GetGreekHeight(dc, region.GetFont()))
 
             if y <= maxY and region != self.GetRegions()[-1]:
                 regionPen = region.GetActualPen()
@@ -207,6 +203,7 @@ class DividedShape(RectangleShape):
         self._width = w
         self._height = h
         self.SetRegionSizes()
+        self.InvalidateBounds()
 
     def SetRegionSizes(self):
         """Set all region sizes according to proportions and this object
@@ -239,6 +236,10 @@ class DividedShape(RectangleShape):
 
             currentY = actualY
 
+        # Attachments follow the region boundaries
+        self.InvalidateAttachments()
+        self.InvalidateSprite()
+
     # Attachment points correspond to regions in the divided box
     def GetAttachmentPosition(self, attachment, nth = 0, no_arcs = 1, line = None):
         totalNumberAttachments = len(self.GetRegions()) * 2 + 2
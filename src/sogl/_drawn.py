@@ -637,7 +637,7 @@ class DrawnShape(RectangleShape):
         if self._shadowMode != SHADOW_NONE:
             if self._shadowBrush:
                 self._metafiles[self._currentAngle]._fillBrush = self._shadowBrush
-            self._metafiles[self._currentAngle]._outlinePen = wx.Pen(wx.WHITE, 1, wx.TRANSPARENT)
+            self._metafiles[self._currentAngle]._outlinePen = FindOrCreatePen(wx.WHITE, 1, wx.TRANSPARENT)
             self._metafiles[self._currentAngle].Draw(dc, self._xpos + self._shadowOffsetX, self._ypos + self._shadowOffsetY)
 
         self._metafiles[self._currentAngle]._outlinePen = self._pen
@@ -664,6 +664,7 @@ class DrawnShape(RectangleShape):
         self._width = w
         self._height = h
         self.SetDefaultRegionSize()
+        self.InvalidateBounds()
 
     def Scale(self, sx, sy):
         """Scale the shape by the given amount."""
@@ -671,6 +672,7 @@ class DrawnShape(RectangleShape):
             if self._metafiles[i].IsValid():
                 self._metafiles[i].Scale(sx, sy)
                 self._metafiles[i].CalculateSize(self)
+        self.InvalidateSprite()
 
     def Translate(self, x, y):
         """Translate the shape by the given amount."""
@@ -678,6 +680,7 @@ class DrawnShape(RectangleShape):
             if self._metafiles[i].IsValid():
                 self._metafiles[i].Translate(x, y)
                 self._metafiles[i].CalculateSize(self)
+        self.InvalidateSprite()
 
     # theta is absolute rotation from the zero position
     def Rotate(self, x, y, theta):
@@ -707,6 +710,7 @@ class DrawnShape(RectangleShape):
         self._rotation = theta
 
         self._metafiles[self._currentAngle].CalculateSize(self)
+        self.InvalidateBounds()
 
     # Which metafile do we use now? Based on current rotation and validity
     # of metafiles.
@@ -749,6 +753,7 @@ class DrawnShape(RectangleShape):
     def LoadFromMetaFile(self, filename):
         """Load a (very simple) Windows metafile, created for example by
         Top Draw, the Windows shareware graphics package."""
+        self.InvalidateSprite()
         return self._metafiles[0].LoadFromMetaFile(filename)
 
     # Set of functions for drawing into a pseudo metafile.
@@ -850,6 +855,10 @@ class DrawnShape(RectangleShape):
         """
         self._metafiles[self._currentAngle].CalculateSize(self)
 
+    def GetSpriteKey(self):
+        # Drawing into the metafile adds operations to it
+        return self._currentAngle, len(self._metafiles[self._currentAngle]._ops)
+
     def DrawAtAngle(self, angle):
         """Set the metafile for the given orientation, which can be one of:
 
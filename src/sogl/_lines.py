@@ -11,10 +11,10 @@
 # Licence:      wxWindows license
 #----------------------------------------------------------------------------
 
-import sys
 import math
 
 from _basic import Shape, ShapeRegion, ShapeTextLine, ControlPoint, RectangleShape
+from _spatial import SegmentTree
 from _soglmisc import *
 
 # Line alignment flags
@@ -131,7 +131,7 @@ class LabelShape(RectangleShape):
         RectangleShape.__init__(self, w, h)
         self._lineShape = parent
         self._shapeRegion = region
-        self.SetPen(wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT))
+        self.SetPen(FindOrCreatePen(wx.BLACK, 1, wx.DOT))
 
     def OnDraw(self, dc):
         if self._lineShape and not self._lineShape.GetDrawHandles():
@@ -142,7 +142,7 @@ class LabelShape(RectangleShape):
 
         if self._pen:
             if self._pen.GetWidth() == 0:
-                dc.SetPen(wx.Pen(wx.WHITE, 1, wx.TRANSPARENT))
+                dc.SetPen(FindOrCreatePen(wx.WHITE, 1, wx.TRANSPARENT))
             else:
                 dc.SetPen(self._pen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
@@ -176,6 +176,23 @@ class LabelShape(RectangleShape):
 
 
 
+# Classes of LineShape that draw exactly like LineShape, see GetBatchLine
+_plainLineClasses = {}
+
+
+
+def _IsPlainLineClass(cls):
+    plain = _plainLineClasses.get(cls)
+    if plain is None:
+        plain = True
+        for name in ["Draw", "OnDraw", "OnDrawContents", "OnDrawControlPoints", "OnDrawBranches"]:
+            if getattr(cls, name).im_func is not getattr(LineShape, name).im_func:
+                plain = False
+        _plainLineClasses[cls] = plain
+    return plain
+
+
+
 class LineShape(Shape):
     """LineShape may be attached to two nodes;
     it may be segmented, in which case a control point is drawn for each joint.
@@ -202,6 +219,12 @@ class LineShape(Shape):
         self._alignmentEnd = 0
 
         self._lineControlPoints = None
+        self._pointBounds = None
+        self._segmentTree = None
+        self._labelRects = None
+        self._curvePoints = None
+        self._drawPoints = None
+        self._arrowGeometry = {}
 
         # Clear any existing regions (created in an earlier constructor)
         # and make the three line regions.
@@ -225,7 +248,7 @@ class LineShape(Shape):
                 self._labelObjects[i].Select(False)
                 self._labelObjects[i].RemoveFromCanvas(self._canvas)
         self._labelObjects = []
-        self.ClearArrowsAtPosition(-1)
+        self._arcArrows = []
 
     def GetFrom(self):
         """Return the 'from' object."""
@@ -249,6 +272,7 @@ class LineShape(Shape):
     def SetSpline(self, spline):
         """Specifies whether a spline is to be drawn through the control points."""
         self._isSpline = spline
+        self.InvalidateBounds()
 
     def IsSpline(self):
         """TRUE if a spline is drawn through the control points."""
@@ -257,10 +281,19 @@ class LineShape(Shape):
     def SetAttachmentFrom(self, attach):
         """Set the 'from' shape attachment."""
         self._attachmentFrom = attach
+        self._InvalidateEndShapes()
 
     def SetAttachmentTo(self, attach):
         """Set the 'to' shape attachment."""
         self._attachmentTo = attach
+        self._InvalidateEndShapes()
+
+    def _InvalidateEndShapes(self):
+        # The shapes at the ends index their lines by attachment
+        if self._from:
+            self._from.InvalidateAttachmentLines()
+        if self._to:
+            self._to.InvalidateAttachmentLines()
 
     def SetIgnoreOffsets(self, ignore):
         """Set whether to ignore offsets from the end of the line when drawing."""
@@ -290,6 +323,7 @@ class LineShape(Shape):
         # pi: added _initialised to keep track of when we have set
         # the middle points to something other than (-999, -999)
         self._initialised = False
+        self.InvalidateBounds()
 
     def InsertLineControlPoint(self, dc = None, point = None):
         """Insert a control point at an optional given position."""
@@ -307,6 +341,7 @@ class LineShape(Shape):
 
         point = wx.RealPoint(line_x, line_y)
         self._lineControlPoints.insert(len(self._lineControlPoints)-1, point)
+        self.InvalidateBounds()
 
     def DeleteLineControlPoint(self):
         """Delete an arbitary point on the line."""
@@ -314,6 +349,7 @@ class LineShape(Shape):
             return False
 
         del self._lineControlPoints[-2]
+        self.InvalidateBounds()
         return True
 
     def Initialise(self):
@@ -344,6 +380,7 @@ class LineShape(Shape):
                         y1 = last_point[1]
                     self._lineControlPoints[i] = wx.RealPoint((x2 - x1) / 2.0 + x1, (y2 - y1) / 2.0 + y1)
                     self._initialised = True
+                    self.InvalidateBounds()
 
     def FormatText(self, dc, s, i):
         """Format a text string according to the region size, adding
@@ -389,6 +426,7 @@ class LineShape(Shape):
 
         CentreText(dc, region.GetFormattedText(), self._xpos, self._ypos, actualW, actualH, region.GetFormatMode())
         self._formatted = True
+        self.InvalidateBounds()
 
     def DrawRegion(self, dc, region, x, y):
         """Format one region at this position."""
@@ -417,7 +455,7 @@ class LineShape(Shape):
                     dc.SetPen(self._pen)
                 dc.SetTextForeground(region.GetActualColourObject())
 
-                DrawFormattedText(dc, region.GetFormattedText(), xp, yp, w, h, region.GetFormatMode())
+                DrawFormattedText(dc, region.GetFormattedText(), xp, yp, w, h, region.GetFormatMode(), self.GetGreekHeight(dc, region.GetFont()))
 
     def EraseRegion(self, dc, region, x, y):
         """Erase one region at this position."""
@@ -473,6 +511,7 @@ class LineShape(Shape):
 
         for i in range(len(self._lineControlPoints) - 2):
             GraphicsStraightenLine(self._lineControlPoints[i], self._lineControlPoints[i + 1])
+        self.InvalidateBounds()
 
         if dc:
             self.Draw(dc)
@@ -483,6 +522,7 @@ class LineShape(Shape):
             self._to.GetLines().remove(self)
         if self._from:
             self._from.GetLines().remove(self)
+        self._InvalidateEndShapes()
         self._to = None
         self._from = None
 
@@ -494,6 +534,7 @@ class LineShape(Shape):
         # Find centre point
         self._xpos = (x1 + x2) / 2.0
         self._ypos = (y1 + y2) / 2.0
+        self.InvalidateBounds()
 
     # Get absolute positions of ends
     def GetEnds(self):
@@ -509,6 +550,7 @@ class LineShape(Shape):
         """
         self._attachmentFrom = from_attach
         self._attachmentTo = to_attach
+        self._InvalidateEndShapes()
 
     def HitTest(self, x, y):
         if not self._lineControlPoints:
@@ -516,44 +558,40 @@ class LineShape(Shape):
 
         # Look at label regions in case mouse is over a label
         inLabelRegion = False
-        for i in range(3):
-            if self._regions[i]:
-                region = self._regions[i]
-                if len(region._formattedText):
-                    xp, yp = self.GetLabelPosition(i)
-                    # Offset region from default label position
-                    cx, cy = region.GetPosition()
-                    cw, ch = region.GetSize()
-                    cx += xp
-                    cy += yp
-
-                    rLeft = cx - cw / 2.0
-                    rTop = cy - ch / 2.0
-                    rRight = cx + cw / 2.0
-                    rBottom = cy + ch / 2.0
-                    if x > rLeft and x < rRight and y > rTop and y < rBottom:
-                        inLabelRegion = True
-                        break
-
-        for i in range(len(self._lineControlPoints) - 1):
-            point1 = self._lineControlPoints[i]
-            point2 = self._lineControlPoints[i + 1]
-
-            # For inaccurate mousing allow 8 pixel corridor
-            extra = 4
+        for rLeft, rTop, rRight, rBottom in self.GetLabelRects():
+            if x > rLeft and x < rRight and y > rTop and y < rBottom:
+                inLabelRegion = True
+                break
+
+        # For inaccurate mousing allow 8 pixel corridor
+        extra = HIT_TOLERANCE
+        if self._canvas:
+            extra /= self._canvas.GetZoom()
+
+        # Only segments whose box is near the point can be hit
+        nearest = None
+        points = self.GetCurvePoints()
+        for i in self.GetSegmentTree().QueryPoint(x, y, extra):
+            point1 = points[i]
+            point2 = points[i + 1]
 
             dx = point2[0] - point1[0]
             dy = point2[1] - point1[1]
-
-            seg_len = math.sqrt(dx * dx + dy * dy)
             if dy == 0 and dx == 0:
                 continue
-            distance_from_seg = seg_len * float((x - point1[0]) * dy - (y - point1[1]) * dx) / (dy * dy + dx * dx)
-            distance_from_prev = seg_len * float((y - point1[1]) * dy + (x - point1[0]) * dx) / (dy * dy + dx * dx)
 
-            if abs(distance_from_seg) < extra and distance_from_prev >= 0 and distance_from_prev <= seg_len or inLabelRegion:
-                return 0, distance_from_seg
+            seg_len = math.sqrt(dx * dx + dy * dy)
+            distance_from_seg = float((x - point1[0]) * dy - (y - point1[1]) * dx) / seg_len
+            distance_from_prev = float((y - point1[1]) * dy + (x - point1[0]) * dx) / seg_len
+
+            if abs(distance_from_seg) < extra and distance_from_prev >= 0 and distance_from_prev <= seg_len:
+                if nearest is None or abs(distance_from_seg) < nearest:
+                    nearest = abs(distance_from_seg)
 
+        if nearest is not None:
+            return 0, nearest
+        if inLabelRegion:
+            return 0, 0.0
         return False
 
     def DrawArrows(self, dc):
@@ -563,7 +601,12 @@ class LineShape(Shape):
         endArrowPos = 0.0
         middleArrowPos = 0.0
 
+        # Arrows too small to see at this scale are left out
+        minSize = self.GetDetailLimits(dc)[1]
+
         for arrow in self._arcArrows:
+            if arrow.GetSize() < minSize:
+                continue
             ah = arrow.GetArrowEnd()
             if ah == ARROW_POSITION_START:
                 if arrow.GetXOffset() and not self._ignoreArrowOffsets:
@@ -588,6 +631,57 @@ class LineShape(Shape):
 
     def DrawArrow(self, dc, arrow, XOffset, proportionalOffset):
         """Draw the given arrowhead (or annotation)."""
+        geometry = self.GetArrowGeometry(arrow, XOffset, proportionalOffset)
+        if not geometry:
+            return
+
+        kind, args = geometry
+        if kind == "polygon":
+            dc.SetPen(self._pen)
+            dc.SetBrush(self._brush)
+            dc.DrawPolygon(args)
+        elif kind == "circle":
+            dc.SetPen(self._pen)
+            if arrow._GetType() == ARROW_HOLLOW_CIRCLE:
+                dc.SetBrush(self.GetBackgroundBrush())
+            else:
+                dc.SetBrush(self._brush)
+            dc.DrawEllipse(*args)
+        elif kind == "metafile":
+            x, y, theta = args
+            # Rotate about the centre of the object, then place
+            # the object on the line.
+            if arrow.GetMetaFile().GetRotateable():
+                arrow.GetMetaFile().Rotate(0.0, 0.0, theta)
+
+            if self._erasing:
+                # If erasing, just draw a rectangle
+                minX, minY, maxX, maxY = arrow.GetMetaFile().GetBounds()
+                # Make erasing rectangle slightly bigger or you get droppings
+                extraPixels = 4
+                dc.DrawRectangle(x + minX - extraPixels / 2.0, y + minY - extraPixels / 2.0, maxX - minX + extraPixels, maxY - minY + extraPixels)
+            else:
+                arrow.GetMetaFile().Draw(dc, x, y)
+
+    def GetArrowGeometry(self, arrow, XOffset, proportionalOffset):
+        """Return what to draw for the given arrowhead, as ("polygon", points),
+        ("circle", (x, y, width, height)) or ("metafile", (x, y, theta)), or
+        None if there is nothing to draw.
+
+        The result is kept until the control points change or the arrow is
+        changed, so redrawing a line does not repeat the calculation.
+        """
+        metaFile = arrow.GetMetaFile()
+        key = (XOffset, proportionalOffset, arrow._GetType(), arrow.GetPosition(), arrow.GetSize(), arrow.GetYOffset(), self._ignoreArrowOffsets, metaFile and metaFile._width)
+        cached = self._arrowGeometry.get(arrow)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        geometry = self._ComputeArrowGeometry(arrow, XOffset, proportionalOffset)
+        self._arrowGeometry[arrow] = key, geometry
+        return geometry
+
+    def _ComputeArrowGeometry(self, arrow, XOffset, proportionalOffset):
         first_line_point = self._lineControlPoints[0]
         second_line_point = self._lineControlPoints[1]
 
@@ -681,9 +775,7 @@ class LineShape(Shape):
                     [side2_x, side2_y],
                     [tip_x, tip_y]]
 
-            dc.SetPen(self._pen)
-            dc.SetBrush(self._brush)
-            dc.DrawPolygon(points)
+            return "polygon", points
         elif at in [ARROW_HOLLOW_CIRCLE, ARROW_FILLED_CIRCLE]:
             # Find point on line of centre of circle, which is a radius away
             # from the end position
@@ -693,15 +785,8 @@ class LineShape(Shape):
                                diameter / 2.0)
             x1 = x - diameter / 2.0
             y1 = y - diameter / 2.0
-            dc.SetPen(self._pen)
-            if arrow._GetType() == ARROW_HOLLOW_CIRCLE:
-                dc.SetBrush(self.GetBackgroundBrush())
-            else:
-                dc.SetBrush(self._brush)
 
-            dc.DrawEllipse(x1, y1, diameter, diameter)
-        elif at == ARROW_SINGLE_OBLIQUE:
-            pass
+            return "circle", (x1, y1, diameter, diameter)
         elif at == ARROW_METAFILE:
             if arrow.GetMetaFile():
                 # Find point on line of centre of object, which is a half-width away
@@ -747,19 +832,8 @@ class LineShape(Shape):
                 else:
                     raise "Unknown arrowhead rotation case"
 
-                # Rotate about the centre of the object, then place
-                # the object on the line.
-                if arrow.GetMetaFile().GetRotateable():
-                    arrow.GetMetaFile().Rotate(0.0, 0.0, theta)
-
-                if self._erasing:
-                    # If erasing, just draw a rectangle
-                    minX, minY, maxX, maxY = arrow.GetMetaFile().GetBounds()
-                    # Make erasing rectangle slightly bigger or you get droppings
-                    extraPixels = 4
-                    dc.DrawRectangle(deltaX + x + minX - extraPixels / 2.0, deltaY + y + minY - extraPixels / 2.0, maxX - minX + extraPixels, maxY - minY + extraPixels)
-                else:
-                    arrow.GetMetaFile().Draw(dc, x + deltaX, y + deltaY)
+                return "metafile", (x + deltaX, y + deltaY, theta)
+        return None
 
     def OnErase(self, dc):
         old_pen = self._pen
@@ -770,7 +844,6 @@ class LineShape(Shape):
         self.SetPen(bg_pen)
         self.SetBrush(bg_brush)
 
-        bound_x, bound_y = self.GetBoundingBoxMax()
         if self._font:
             dc.SetFont(self._font)
 
@@ -787,8 +860,8 @@ class LineShape(Shape):
         # Drawing over the line only seems to work if the line has a thickness
         # of 1.
         if old_pen and old_pen.GetWidth() > 1:
-            dc.DrawRectangle(self._xpos - bound_x / 2.0 - 2, self._ypos - bound_y / 2.0 - 2,
-                             bound_x + 4, bound_y + 4)
+            left, top, right, bottom = self.GetPointBounds()
+            dc.DrawRectangle(left - 2, top - 2, right - left + 4, bottom - top + 4)
         else:
             self._erasing = True
             self.GetEventHandler().OnDraw(dc)
@@ -800,20 +873,140 @@ class LineShape(Shape):
         if old_brush:
             self.SetBrush(old_brush)
 
-    def GetBoundingBoxMin(self):
-        x1, y1 = 10000, 10000
-        x2, y2 = -10000, -10000
+    def InvalidateBounds(self):
+        self._pointBounds = None
+        self._segmentTree = None
+        self._labelRects = None
+        self._curvePoints = None
+        self._drawPoints = None
+        self._arrowGeometry = {}
+        Shape.InvalidateBounds(self)
+
+    def GetPointBounds(self):
+        """Return the (left, top, right, bottom) rectangle spanned by the
+        line as drawn, see GetCurvePoints.
+        """
+        if self._pointBounds is None:
+            x1, y1 = 10000, 10000
+            x2, y2 = -10000, -10000
+
+            for point in self.GetCurvePoints():
+                if point[0] < x1:
+                    x1 = point[0]
+                if point[1] < y1:
+                    y1 = point[1]
+                if point[0] > x2:
+                    x2 = point[0]
+                if point[1] > y2:
+                    y2 = point[1]
+
+            self._pointBounds = x1, y1, x2, y2
+        return self._pointBounds
+
+    def CalculateWorldBounds(self):
+        if not self._lineControlPoints:
+            return self._xpos, self._ypos, self._xpos, self._ypos
 
-        for point in self._lineControlPoints:
-            if point[0] < x1:
-                x1 = point[0]
-            if point[1] < y1:
-                y1 = point[1]
-            if point[0] > x2:
-                x2 = point[0]
-            if point[1] > y2:
-                y2 = point[1]
+        left, top, right, bottom = self.GetPointBounds()
+
+        # Arrowheads stick out sideways by their size and y offset, and those
+        # stacked at one end can reach past a short end segment
+        extra = 0.0
+        stacked = {}
+        for arrow in self._arcArrows:
+            end = arrow.GetArrowEnd()
+            reach = stacked.get(end, 0.0) + arrow.GetSize()
+            stacked[end] = reach + arrow.GetSpacing()
+            extra = max(extra, reach + abs(arrow.GetYOffset()))
 
+        # The pen is centred on the line
+        if self._pen:
+            extra += self._pen.GetWidth() / 2.0
+
+        left -= extra
+        top -= extra
+        right += extra
+        bottom += extra
+
+        # Include the label regions, which are hit as part of the line
+        for rLeft, rTop, rRight, rBottom in self.GetLabelRects():
+            left = min(left, rLeft)
+            top = min(top, rTop)
+            right = max(right, rRight)
+            bottom = max(bottom, rBottom)
+
+        return left, top, right, bottom
+
+    def GetSegmentTree(self):
+        """Return the SegmentTree over the segments of GetCurvePoints, which
+        is rebuilt when the control points change.
+        """
+        if self._segmentTree is None:
+            self._segmentTree = SegmentTree(self.GetCurvePoints())
+        return self._segmentTree
+
+    def GetCurvePoints(self):
+        """Return the points of the line as drawn: the control points, or
+        for a spline the polyline wx.DC.DrawSpline would draw through them,
+        used for hit testing and bounds. This is rebuilt when the control
+        points change.
+        """
+        if self._curvePoints is None:
+            if self._isSpline and len(self._lineControlPoints) > 2:
+                self._curvePoints = GetSplinePoints(self._lineControlPoints)
+            else:
+                self._curvePoints = self._lineControlPoints or []
+        return self._curvePoints
+
+    def GetDrawPoints(self):
+        """Return the line control points as a list of wx.Point, which is
+        rebuilt when the control points change.
+        """
+        if self._drawPoints is None:
+            self._drawPoints = [wx.Point(point[0], point[1]) for point in self._lineControlPoints]
+        return self._drawPoints
+
+    def DrawSimplified(self, dc):
+        if not self._lineControlPoints:
+            return
+        if self._pen:
+            dc.SetPen(self._pen)
+        dc.DrawLines(self.GetDrawPoints())
+
+    def GetBatchLine(self):
+        if len(self._lineControlPoints) != 2 or not self._pen or not self._visible:
+            return None
+        if self._isSpline or self._arcArrows or self._selected or self._cacheSprite:
+            return None
+        if self._attachmentMode == ATTACHMENT_MODE_BRANCHING or self.GetLabelRects():
+            return None
+        if self._eventHandler is not self or not _IsPlainLineClass(self.__class__):
+            return None
+
+        start, end = self.GetDrawPoints()
+        return self._pen, (start[0], start[1], end[0], end[1])
+
+    def GetLabelRects(self):
+        """Return a list of (left, top, right, bottom) rectangles of the
+        label regions that have text.
+        """
+        if self._labelRects is None:
+            rects = []
+            for i, region in enumerate(self._regions[:3]):
+                if region and region.GetFormattedText():
+                    xp, yp = self.GetLabelPosition(i)
+                    # Offset region from default label position
+                    cx, cy = region.GetPosition()
+                    cw, ch = region.GetSize()
+                    cx += xp
+                    cy += yp
+
+                    rects.append((cx - cw / 2.0, cy - ch / 2.0, cx + cw / 2.0, cy + ch / 2.0))
+            self._labelRects = rects
+        return self._labelRects
+
+    def GetBoundingBoxMin(self):
+        x1, y1, x2, y2 = self.GetPointBounds()
         return x2 - x1, y2 - y1
 
     # For a node image of interest, finds the position of this arc
@@ -825,14 +1018,20 @@ class LineShape(Shape):
         Specify whether incoming or outgoing lines are being considered
         with incoming.
         """
-        n = -1
-        num = 0
-
         if image == self._to:
             this_attachment = self._attachmentTo
         else:
             this_attachment = self._attachmentFrom
 
+        # The shape keeps an index of its line ends by attachment. A line
+        # with both ends on image may have its nth end counted at the other
+        # attachment, so fall back to counting for those.
+        if not (image == self._to and image == self._from):
+            return image.GetAttachmentLineEnd(self, incoming), image.GetAttachmentEndCount(this_attachment)
+
+        n = -1
+        num = 0
+
         # Find number of lines going into / out of this particular attachment point
         for line in image.GetLines():
             if line._from == image:
@@ -859,7 +1058,7 @@ class LineShape(Shape):
         old_pen = self._pen
         old_brush = self._brush
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         self.SetPen(dottedPen)
         self.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -1003,24 +1202,23 @@ class LineShape(Shape):
         if self._brush:
             dc.SetBrush(self._brush)
 
-        points = []
-        for point in self._lineControlPoints:
-            points.append(wx.Point(point[0], point[1]))
+        points = self.GetDrawPoints()
 
+        # Splines are drawn by the DC, which keeps them smooth when zoomed
+        # in; GetCurvePoints is only used for hit testing and bounds
         if self._isSpline:
             dc.DrawSpline(points)
         else:
             dc.DrawLines(points)
 
-        if sys.platform[:3] == "win":
-            # For some reason, last point isn't drawn under Windows
+        if DRAW_LAST_POINT:
             pt = points[-1]
             dc.DrawPoint(pt[0], pt[1])
 
         # Problem with pen - if not a solid pen, does strange things
         # to the arrowhead. So make (get) a new pen that's solid.
         if self._pen and self._pen.GetStyle() != wx.SOLID:
-            solid_pen = wx.Pen(self._pen.GetColour(), 1, wx.SOLID)
+            solid_pen = FindOrCreatePen(self._pen.GetColour(), 1, wx.SOLID)
             if solid_pen:
                 dc.SetPen(solid_pen)
 
@@ -1066,11 +1264,15 @@ class LineShape(Shape):
 
     def SetTo(self, object):
         """Set the 'to' object for the line."""
+        self._InvalidateEndShapes()
         self._to = object
+        self._InvalidateEndShapes()
 
     def SetFrom(self, object):
         """Set the 'from' object for the line."""
+        self._InvalidateEndShapes()
         self._from = object
+        self._InvalidateEndShapes()
 
     def MakeControlPoints(self):
         """Make handle control points."""
@@ -1135,12 +1337,9 @@ class LineShape(Shape):
     # Control points ('handles') redirect control to the actual shape, to
     # make it easier to override sizing behaviour.
     def OnSizingDragLeft(self, pt, draw, x, y, keys = 0, attachment = 0):
-        dc = wx.ClientDC(self.GetCanvas())
-        self.GetCanvas().PrepareDC(dc)
-
-        dc.SetLogicalFunction(OGLRBLF)
+        dc = self.GetCanvas().GetOverlayDC()
 
-        dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
+        dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
         dc.SetPen(dottedPen)
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
@@ -1149,56 +1348,55 @@ class LineShape(Shape):
 
             pt.SetX(x)
             pt.SetY(y)
-            pt._point[0] = x
-            pt._point[1] = y
 
-            old_pen = self.GetPen()
-            old_brush = self.GetBrush()
+            self._DrawControlPointOutline(dc, pt, x, y)
 
-            self.SetPen(dottedPen)
-            self.SetBrush(wx.TRANSPARENT_BRUSH)
-
-            self.GetEventHandler().OnMoveLink(dc, False)
+    def _DrawControlPointOutline(self, dc, pt, x, y):
+        # Draw the line as it would be with the control point of pt moved
+        # to x, y, without changing the line itself
+        points = []
+        for point in self._lineControlPoints:
+            if point is pt._point:
+                points.append(wx.Point(x, y))
+            else:
+                points.append(wx.Point(point[0], point[1]))
 
-            self.SetPen(old_pen)
-            self.SetBrush(old_brush)
+        if self._isSpline:
+            dc.DrawSpline(points)
+        else:
+            dc.DrawLines(points)
 
     def OnSizingBeginDragLeft(self, pt, x, y, keys = 0, attachment = 0):
         dc = wx.ClientDC(self.GetCanvas())
         self.GetCanvas().PrepareDC(dc)
 
         if pt._type == CONTROL_POINT_LINE:
-            pt._originalPos = pt._point
+            pt._originalPos = wx.RealPoint(pt._point[0], pt._point[1])
             x, y = self._canvas.Snap(x, y)
 
-            self.Erase(dc)
+            # In buffered mode the line stays as it is, drawing on the
+            # window would be undone by the next paint from the buffer
+            if not self._canvas.GetBufferedMode():
+                self.Erase(dc)
 
-            # Redraw start and end objects because we've left holes
-            # when erasing the line
-            self.GetFrom().OnDraw(dc)
-            self.GetFrom().OnDrawContents(dc)
-            self.GetTo().OnDraw(dc)
-            self.GetTo().OnDrawContents(dc)
+                # Redraw start and end objects because we've left holes
+                # when erasing the line
+                self.GetFrom().OnDraw(dc)
+                self.GetFrom().OnDrawContents(dc)
+                self.GetTo().OnDraw(dc)
+                self.GetTo().OnDrawContents(dc)
 
             self.SetDisableLabel(True)
-            dc.SetLogicalFunction(OGLRBLF)
+            dc = self.GetCanvas().GetOverlayDC()
 
             pt._xpos = x
             pt._ypos = y
-            pt._point[0] = x
-            pt._point[1] = y
 
-            old_pen = self.GetPen()
-            old_brush = self.GetBrush()
+            dottedPen = FindOrCreatePen(wx.BLACK, 1, wx.DOT)
+            dc.SetPen(dottedPen)
+            dc.SetBrush(wx.TRANSPARENT_BRUSH)
 
-            dottedPen = wx.Pen(wx.Colour(0, 0, 0), 1, wx.DOT)
-            self.SetPen(dottedPen)
-            self.SetBrush(wx.TRANSPARENT_BRUSH)
-
-            self.GetEventHandler().OnMoveLink(dc, False)
-
-            self.SetPen(old_pen)
-            self.SetBrush(old_brush)
+            self._DrawControlPointOutline(dc, pt, x, y)
 
         if pt._type == CONTROL_POINT_ENDPOINT_FROM or pt._type == CONTROL_POINT_ENDPOINT_TO:
             self._canvas.SetCursor(wx.StockCursor(wx.CURSOR_BULLSEYE))
@@ -1215,15 +1413,12 @@ class LineShape(Shape):
 
             rpt = wx.RealPoint(x, y)
 
-            # Move the control point back to where it was;
+            # Move the handle back to where it was;
             # MoveControlPoint will move it to the new position
-            # if it decides it wants. We only moved the position
-            # during user feedback so we could redraw the line
-            # as it changed shape.
+            # if it decides it wants. We only moved the handle
+            # during user feedback.
             pt._xpos = pt._originalPos[0]
             pt._ypos = pt._originalPos[1]
-            pt._point[0] = pt._originalPos[0]
-            pt._point[1] = pt._originalPos[1]
 
             self.OnMoveMiddleControlPoint(dc, pt, rpt)
 
@@ -1241,6 +1436,9 @@ class LineShape(Shape):
             if self.GetTo():
                 self.GetTo().MoveLineToNewAttachment(dc, self, x, y)
 
+        if not self._canvas.GetQuickEditMode():
+            self._canvas.RefreshDamage()
+
     # This is called only when a non-end control point is moved
     def OnMoveMiddleControlPoint(self, dc, lpt, pt):
         lpt._xpos = pt[0]
@@ -1291,6 +1489,7 @@ class LineShape(Shape):
         """
         arrow = ArrowHead(type, end, size, xOffset, name, mf, arrowId)
         self._arcArrows.append(arrow)
+        self.InvalidateBounds()
         return arrow
 
     # Add arrowhead at a particular position in the arrowhead list
@@ -1320,6 +1519,7 @@ class LineShape(Shape):
         refArrow = referenceList[0]
         if refArrow.GetName() == targetName:
             self._arcArrows.insert(0, arrow)
+            self.InvalidateBounds()
             return True
 
         i1 = i2 = 0
@@ -1338,10 +1538,12 @@ class LineShape(Shape):
                     self._arcArrows.insert(i2, arrow)
                 else:
                     self._arcArrows.append(arrow)
+                self.InvalidateBounds()
                 return True
             i1 += 1
 
         self._arcArrows.append(arrow)
+        self.InvalidateBounds()
         return True
 
     def ClearArrowsAtPosition(self, end):
@@ -1350,17 +1552,18 @@ class LineShape(Shape):
         """
         if end == -1:
             self._arcArrows = []
-            return
-
-        for arrow in self._arcArrows:
-            if arrow.GetArrowEnd() == end:
-                self._arcArrows.remove(arrow)
+        else:
+            for arrow in self._arcArrows:
+                if arrow.GetArrowEnd() == end:
+                    self._arcArrows.remove(arrow)
+        self.InvalidateBounds()
 
     def ClearArrow(self, name):
         """Delete the arrow with the given name."""
         for arrow in self._arcArrows:
             if arrow.GetName() == name:
                 self._arcArrows.remove(arrow)
+                self.InvalidateBounds()
                 return True
         return False
 
@@ -1391,6 +1594,7 @@ class LineShape(Shape):
         for arrow in self._arcArrows:
             if (position == -1 or position == arrow.GetArrowEnd()) and arrow.GetName() == name:
                 self._arcArrows.remove(arrow)
+                self.InvalidateBounds()
                 return True
         return False
 
@@ -1399,6 +1603,7 @@ class LineShape(Shape):
         for arrow in self._arcArrows:
             if arrowId == arrow.GetId():
                 self._arcArrows.remove(arrow)
+                self.InvalidateBounds()
                 return True
         return False
 
@@ -1515,6 +1720,7 @@ class LineShape(Shape):
         labelShape._shapeRegion.SetPosition(x - xx, y - yy)
         labelShape.SetX(x)
         labelShape.SetY(y)
+        self.InvalidateBounds()
 
         # Need to reformat to fit region
         if labelShape._shapeRegion.GetText():
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# Name:         overlay.py
+# Purpose:      Interactive feedback drawn over the diagram
+#
+# Created:      17-10-2026
+# Licence:      wxWindows license
+#----------------------------------------------------------------------------
+
+from collections import OrderedDict
+
+import wx
+
+from _soglmisc import OGLRBLF
+
+# Drawing operations whose first four arguments are x, y, width, height
+_RECT_OPS = set(["DrawRectangle", "DrawRoundedRectangle", "DrawEllipse"])
+
+# Drawing operations whose first argument is a list of points, optionally
+# followed by x and y offsets
+_POINT_LIST_OPS = set(["DrawLines", "DrawPolygon", "DrawSpline"])
+
+
+
+def _Freeze(value):
+    # Make point lists hashable, so that operations can be compared
+    if isinstance(value, (list, tuple, wx.Point, wx.RealPoint)):
+        return tuple(_Freeze(v) for v in value)
+    return value
+
+
+
+def GetOperationBounds(name, args):
+    """Return the (left, top, right, bottom) rectangle covered by a drawing
+    operation, not counting the pen width, or None if it is not known.
+    """
+    if name in _RECT_OPS:
+        x, y, w, h = args[:4]
+        return min(x, x + w), min(y, y + h), max(x, x + w), max(y, y + h)
+    elif name == "DrawLine":
+        x1, y1, x2, y2 = args[:4]
+        return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+    elif name == "DrawPoint":
+        x, y = args[:2]
+        return x, y, x, y
+    elif name == "DrawCircle":
+        x, y, r = args[:3]
+        return x - r, y - r, x + r, y + r
+    elif name in _POINT_LIST_OPS and args[0]:
+        xoffset = yoffset = 0
+        if len(args) > 1:
+            xoffset = args[1]
+        if len(args) > 2:
+            yoffset = args[2]
+        xs = [point[0] for point in args[0]]
+        ys = [point[1] for point in args[0]]
+        return min(xs) + xoffset, min(ys) + yoffset, max(xs) + xoffset, max(ys) + yoffset
+    return None
+
+
+
+class Overlay(object):
+    """Interactive feedback such as drag outlines and rubber bands, kept as
+    a list of drawing operations and drawn over the diagram when the canvas
+    is painted.
+
+    Adding an operation that is already in the overlay removes it again,
+    just like drawing the same thing twice with OGLRBLF.
+    """
+    def __init__(self):
+        self._ops = OrderedDict()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def Toggle(self, op):
+        """Add the (name, args, pen, brush, logicalFunction) operation, or
+        remove it if it is already there.
+        """
+        if op in self._ops:
+            del self._ops[op]
+        else:
+            self._ops[op] = None
+
+    def Clear(self):
+        """Remove all operations."""
+        self._ops = OrderedDict()
+
+    def GetOperations(self):
+        """Return the operations in drawing order."""
+        return self._ops.keys()
+
+    def Draw(self, dc):
+        """Draw the operations on dc."""
+        for name, args, pen, brush, function in self._ops:
+            if pen:
+                dc.SetPen(pen)
+            if brush:
+                dc.SetBrush(brush)
+            dc.SetLogicalFunction(function)
+            getattr(dc, name)(*args)
+        dc.SetLogicalFunction(wx.COPY)
+
+
+
+class OverlayDC(object):
+    """Stands in for a device context while drawing interactive feedback,
+    see ShapeCanvas.GetOverlayDC.
+
+    Calls to Draw methods are added to the canvas overlay instead of being
+    drawn. Other methods are passed on to the given, prepared, DC.
+    """
+    def __init__(self, canvas, dc):
+        self._canvas = canvas
+        self._dc = dc
+        self._pen = None
+        self._brush = None
+        self._logicalFunction = OGLRBLF
+
+    def __getattr__(self, name):
+        if name.startswith("Draw"):
+            def draw(*args):
+                self._canvas.ToggleOverlay((name, _Freeze(args), self._pen, self._brush, self._logicalFunction))
+            return draw
+        return getattr(self._dc, name)
+
+    def SetPen(self, pen):
+        self._pen = pen
+
+    def SetBrush(self, brush):
+        self._brush = brush
+
+    def SetLogicalFunction(self, function):
+        self._logicalFunction = function
+
+    def GetLogicalFunction(self):
+        return self._logicalFunction
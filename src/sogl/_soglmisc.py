@@ -11,6 +11,7 @@
 # Licence:      wxWindows license
 #----------------------------------------------------------------------------
 
+import sys
 import math
 
 import wx
@@ -45,11 +46,43 @@ OP_ALL = OP_CLICK_LEFT | OP_CLICK_RIGHT | OP_DRAG_LEFT | OP_DRAG_RIGHT
 BRANCHING_ATTACHMENT_NORMAL = 1
 BRANCHING_ATTACHMENT_BLOB = 2
 
+# Diameter of the blobs drawn with BRANCHING_ATTACHMENT_BLOB
+BRANCH_BLOB_SIZE = 6.0
+
 # logical function to use when drawing rubberband boxes, etc.
 OGLRBLF = wx.INVERT
 
 CONTROL_POINT_SIZE = 6
 
+# Distance around a shape's bounds within which HitTest may still succeed
+# (allowance for inaccurate mousing).
+HIT_TOLERANCE = 4
+
+# Region query modes for Diagram.FindShapesInRect
+RECT_INTERSECTS, RECT_CONTAINS = 0, 1
+
+# Space around a shape's bounds that drawing it may cover (pen width,
+# arrowheads), added to damaged rectangles before repainting.
+DAMAGE_MARGIN = 8
+
+# Damaged rectangles kept before they are merged into one
+MAX_DAMAGE_RECTS = 64
+
+# Level of detail thresholds in screen pixels for zoomed out views, see
+# Diagram.SetDetailThresholds. Text with a smaller height is drawn as bars,
+# smaller arrowheads, shadows and branches are left out, and smaller shapes
+# are drawn as plain rectangles.
+GREEK_TEXT_SIZE = 5
+MIN_DETAIL_SIZE = 2
+MIN_SHAPE_SIZE = 3
+
+# Spline curves are split until the pieces are this close to straight,
+# the same as wx.DC.DrawSpline
+SPLINE_THRESHOLD = 4
+
+# For some reason, the last point of a line isn't drawn under Windows
+DRAW_LAST_POINT = sys.platform[:3] == "win"
+
 # Types of arrowhead
 # (i) Built-in
 ARROW_HOLLOW_CIRCLE   = 1
@@ -209,7 +242,10 @@ def CentreText(dc, text_list, xpos, ypos, width, height, formatMode):
 
 
 
-def DrawFormattedText(dc, text_list, xpos, ypos, width, height, formatMode):
+def DrawFormattedText(dc, text_list, xpos, ypos, width, height, formatMode, greekHeight = 0):
+    """Draw the formatted text lines. If greekHeight is nonzero, each
+    line is drawn as a bar instead, for text too small to read.
+    """
     if formatMode & FORMAT_CENTRE_HORIZ:
         xoffset = xpos
     else:
@@ -223,8 +259,15 @@ def DrawFormattedText(dc, text_list, xpos, ypos, width, height, formatMode):
     # +1 to allow for rounding errors
     dc.SetClippingRegion(xpos - width / 2.0, ypos - height / 2.0, width + 1, height + 1)
 
-    for line in text_list:
-        dc.DrawText(line.GetText(), xoffset + line.GetX(), yoffset + line.GetY())
+    if greekHeight:
+        dc.SetPen(FindOrCreatePen(wx.WHITE, 1, wx.TRANSPARENT))
+        dc.SetBrush(FindOrCreateBrush(dc.GetTextForeground()))
+        for line in text_list:
+            barWidth = min(len(line.GetText()) * greekHeight / 2.0, width)
+            dc.DrawRectangle(xoffset + line.GetX(), yoffset + line.GetY() + greekHeight / 4.0, barWidth, greekHeight / 2.0)
+    else:
+        for line in text_list:
+            dc.DrawText(line.GetText(), xoffset + line.GetX(), yoffset + line.GetY())
 
     dc.DestroyClippingRegion()
 
@@ -324,6 +367,30 @@ def PolylineHitTest(xvec, yvec, x1, y1, x2, y2):
 
 
 
+def PointInPolygon(xvec, yvec, x, y):
+    """True if the point lies inside the polygon given by the vertex vectors,
+    using the even-odd rule.
+    """
+    inside = False
+    lastx = xvec[-1]
+    lasty = yvec[-1]
+
+    for i in range(len(xvec)):
+        curx = xvec[i]
+        cury = yvec[i]
+
+        # Count the edges crossing the horizontal ray to the right of the point
+        if (cury > y) != (lasty > y):
+            if x < (lastx - curx) * (y - cury) / float(lasty - cury) + curx:
+                inside = not inside
+
+        lastx = curx
+        lasty = cury
+
+    return inside
+
+
+
 def GraphicsStraightenLine(point1, point2):
     dx = point2[0] - point1[0]
     dy = point2[1] - point1[1]
@@ -365,6 +432,57 @@ def GetArrowPoints(x1, y1, x2, y2, length, width):
 
 
 
+def _AddQuadraticSpline(curve, a1, b1, a2, b2, a3, b3, a4, b4):
+    stack = [(a1, b1, a2, b2, a3, b3, a4, b4)]
+    while stack:
+        x1, y1, x2, y2, x3, y3, x4, y4 = stack.pop()
+        xmid = (x2 + x3) / 2.0
+        ymid = (y2 + y3) / 2.0
+        if abs(x1 - xmid) < SPLINE_THRESHOLD and abs(y1 - ymid) < SPLINE_THRESHOLD and \
+           abs(xmid - x4) < SPLINE_THRESHOLD and abs(ymid - y4) < SPLINE_THRESHOLD:
+            curve.append((x1, y1))
+            curve.append((xmid, ymid))
+        else:
+            stack.append((xmid, ymid, (xmid + x3) / 2.0, (ymid + y3) / 2.0, (x3 + x4) / 2.0, (y3 + y4) / 2.0, x4, y4))
+            stack.append((x1, y1, (x1 + x2) / 2.0, (y1 + y2) / 2.0, (x2 + xmid) / 2.0, (y2 + ymid) / 2.0, xmid, ymid))
+
+
+
+def GetSplinePoints(points):
+    """Return the polyline, as a list of (x, y) tuples, that wx.DC.DrawSpline
+    draws through the given points.
+    """
+    if len(points) < 2:
+        return [(point[0], point[1]) for point in points]
+
+    x1, y1 = points[0][0], points[0][1]
+    x2, y2 = points[1][0], points[1][1]
+    cx1 = (x1 + x2) / 2.0
+    cy1 = (y1 + y2) / 2.0
+    cx2 = (cx1 + x2) / 2.0
+    cy2 = (cy1 + y2) / 2.0
+
+    curve = [(x1, y1)]
+    for point in points[2:]:
+        x1, y1 = x2, y2
+        x2, y2 = point[0], point[1]
+        cx4 = (x1 + x2) / 2.0
+        cy4 = (y1 + y2) / 2.0
+        cx3 = (x1 + cx4) / 2.0
+        cy3 = (y1 + cy4) / 2.0
+
+        _AddQuadraticSpline(curve, cx1, cy1, cx2, cy2, cx3, cy3, cx4, cy4)
+
+        cx1, cy1 = cx4, cy4
+        cx2 = (cx1 + x2) / 2.0
+        cy2 = (cy1 + y2) / 2.0
+
+    curve.append((cx1, cy1))
+    curve.append((x2, y2))
+    return curve
+
+
+
 def DrawArcToEllipse(x1, y1, width1, height1, x2, y2, x3, y3):
     a1 = width1 / 2.0
     b1 = height1 / 2.0
@@ -413,3 +531,30 @@ def FindEndForCircle(radius, x1, y1, x2, y2):
         return x1, y1
     else:
         return radius * (x2 - x1) / H + x1, radius * (y2 - y1) / H + y1
+
+
+
+def FindOrCreatePen(colour, width = 1, style = wx.SOLID):
+    """Return a pen with the given colour (a wx.Colour or a colour name),
+    width and style from wx.ThePenList, which only creates it the first
+    time it is asked for.
+
+    The pen is shared and must not be modified.
+    """
+    return wx.ThePenList.FindOrCreatePen(colour, width, style)
+
+
+
+def FindOrCreateBrush(colour, style = wx.SOLID):
+    """Return a shared brush with the given colour and style from
+    wx.TheBrushList, see FindOrCreatePen.
+    """
+    return wx.TheBrushList.FindOrCreateBrush(colour, style)
+
+
+
+def FindOrCreateFont(pointSize, family, style, weight, underline = False, faceName = ""):
+    """Return a shared font with the given attributes from wx.TheFontList,
+    see FindOrCreatePen.
+    """
+    return wx.TheFontList.FindOrCreateFont(pointSize, family, style, weight, underline, faceName)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# Name:         spatial.py
+# Purpose:      Spatial index used for fast shape lookup
+#
+# Created:      17-10-2026
+# Licence:      wxWindows license
+#----------------------------------------------------------------------------
+
+import math
+
+# Default edge length of a grid cell in logical units
+DEFAULT_CELL_SIZE = 128.0
+
+# Objects covering more cells than this are kept in a separate list
+# instead of being entered into every cell they touch.
+MAX_OBJECT_CELLS = 256
+
+
+
+def MergeRects(rects):
+    """Merge overlapping (left, top, right, bottom) rectangles and return
+    a list of disjoint rectangles covering all of them.
+    """
+    merged = []
+    for rect in rects:
+        left, top, right, bottom = rect
+        # Absorb every rectangle overlapping this one; the result may then
+        # overlap others, so keep going until nothing changes.
+        changed = True
+        while changed:
+            changed = False
+            for other in merged:
+                l, t, r, b = other
+                if l <= right and r >= left and t <= bottom and b >= top:
+                    merged.remove(other)
+                    left, top = min(left, l), min(top, t)
+                    right, bottom = max(right, r), max(bottom, b)
+                    changed = True
+                    break
+        merged.append((left, top, right, bottom))
+    return merged
+
+
+
+
+class SpatialIndex(object):
+    """A uniform grid over axis-aligned bounding boxes.
+
+    Each object is stored together with its bounds, given as a
+    (left, top, right, bottom) tuple, and entered into every grid cell
+    the bounds touch. Queries only look at the cells under the query
+    rectangle.
+    """
+    def __init__(self, cellSize = DEFAULT_CELL_SIZE):
+        self._cellSize = float(cellSize)
+        self._cells = {}
+        self._bounds = {}
+        self._large = set()
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def __contains__(self, obj):
+        return obj in self._bounds
+
+    def GetCellSize(self):
+        """Return the edge length of a grid cell."""
+        return self._cellSize
+
+    def _GetCellRange(self, bounds):
+        left, top, right, bottom = bounds
+        size = self._cellSize
+        return (int(math.floor(left / size)), int(math.floor(top / size)),
+                int(math.floor(right / size)), int(math.floor(bottom / size)))
+
+    def Insert(self, obj, bounds):
+        """Add obj with the given (left, top, right, bottom) bounds, replacing
+        any previous entry for it.
+        """
+        if obj in self._bounds:
+            self.Remove(obj)
+
+        self._bounds[obj] = bounds
+
+        i1, j1, i2, j2 = self._GetCellRange(bounds)
+        if (i2 - i1 + 1) * (j2 - j1 + 1) > MAX_OBJECT_CELLS:
+            self._large.add(obj)
+            return
+
+        cells = self._cells
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                cell = cells.get((i, j))
+                if cell is None:
+                    cells[(i, j)] = set([obj])
+                else:
+                    cell.add(obj)
+
+    def Remove(self, obj):
+        """Remove obj from the index. Does nothing if it is not indexed."""
+        bounds = self._bounds.pop(obj, None)
+        if bounds is None:
+            return
+
+        if obj in self._large:
+            self._large.remove(obj)
+            return
+
+        i1, j1, i2, j2 = self._GetCellRange(bounds)
+        cells = self._cells
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                cell = cells.get((i, j))
+                if cell is not None:
+                    cell.discard(obj)
+                    if not cell:
+                        del cells[(i, j)]
+
+    def Update(self, obj, bounds):
+        """Change the bounds stored for obj."""
+        old = self._bounds.get(obj)
+        if old is not None and obj not in self._large and \
+           self._GetCellRange(old) == self._GetCellRange(bounds):
+            # Still covers the same cells, only the stored box changes
+            self._bounds[obj] = bounds
+            return
+        self.Insert(obj, bounds)
+
+    def Clear(self):
+        """Remove all objects from the index."""
+        self._cells = {}
+        self._bounds = {}
+        self._large = set()
+
+    def GetBounds(self, obj):
+        """Return the bounds stored for obj, or None if it is not indexed."""
+        return self._bounds.get(obj)
+
+    def Query(self, left, top, right, bottom):
+        """Return the set of objects whose bounds intersect the given
+        rectangle.
+        """
+        bounds = self._bounds
+        found = set()
+
+        i1, j1, i2, j2 = self._GetCellRange((left, top, right, bottom))
+        if (i2 - i1 + 1) * (j2 - j1 + 1) > len(self._cells):
+            # Fewer occupied cells than cells under the rectangle
+            cells = [cell for (i, j), cell in self._cells.iteritems() if i1 <= i <= i2 and j1 <= j <= j2]
+        else:
+            cells = []
+            for i in range(i1, i2 + 1):
+                for j in range(j1, j2 + 1):
+                    cell = self._cells.get((i, j))
+                    if cell is not None:
+                        cells.append(cell)
+
+        for cell in cells:
+            for obj in cell:
+                if obj in found:
+                    continue
+                l, t, r, b = bounds[obj]
+                if l <= right and r >= left and t <= bottom and b >= top:
+                    found.add(obj)
+
+        for obj in self._large:
+            l, t, r, b = bounds[obj]
+            if l <= right and r >= left and t <= bottom and b >= top:
+                found.add(obj)
+
+        return found
+
+    def QueryPoint(self, x, y, tolerance = 0):
+        """Return the set of objects whose bounds lie within tolerance of
+        the given point.
+        """
+        return self.Query(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+
+
+
+class SegmentTree(object):
+    """A bounding volume hierarchy over the segments of a polyline.
+
+    Leaves hold the bounding box of a run of consecutive segments and
+    every inner node the union of its two children. Since neighbouring
+    segments of a polyline lie close together this gives tight boxes,
+    and a point query only descends into the few nodes near the point.
+    """
+    # Number of segments stored in one leaf
+    LEAF_SIZE = 4
+
+    def __init__(self, points):
+        self._points = list(points)
+        self._nodes = []
+        self._root = None
+        if len(self._points) > 1:
+            self._root = self._Build(0, len(self._points) - 1)
+
+    def __len__(self):
+        return max(len(self._points) - 1, 0)
+
+    def _Build(self, start, end):
+        # Node covering segments start .. end - 1. Each node is stored as
+        # [left, top, right, bottom, start, end, child1, child2].
+        if end - start <= self.LEAF_SIZE:
+            xs = [p[0] for p in self._points[start:end + 1]]
+            ys = [p[1] for p in self._points[start:end + 1]]
+            node = [min(xs), min(ys), max(xs), max(ys), start, end, None, None]
+        else:
+            mid = (start + end) // 2
+            a = self._Build(start, mid)
+            b = self._Build(mid, end)
+            node = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]), start, end, a, b]
+        self._nodes.append(node)
+        return node
+
+    def GetBounds(self):
+        """Return the (left, top, right, bottom) box of all segments, or
+        None if there are no segments.
+        """
+        if self._root is None:
+            return None
+        return tuple(self._root[:4])
+
+    def QueryPoint(self, x, y, tolerance = 0):
+        """Return the indices of the segments whose bounding box lies within
+        tolerance of the given point, in ascending order. Index i refers to
+        the segment from point i to point i + 1.
+        """
+        found = []
+        if self._root is None:
+            return found
+
+        points = self._points
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if x < node[0] - tolerance or x > node[2] + tolerance or \
+               y < node[1] - tolerance or y > node[3] + tolerance:
+                continue
+            if node[6] is not None:
+                stack.append(node[7])
+                stack.append(node[6])
+                continue
+            for i in range(node[4], node[5]):
+                x1, y1 = points[i]
+                x2, y2 = points[i + 1]
+                if x >= min(x1, x2) - tolerance and x <= max(x1, x2) + tolerance and \
+                   y >= min(y1, y2) - tolerance and y <= max(y1, y2) + tolerance:
+                    found.append(i)
+        return found
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# Name:         sprite.py
+# Purpose:      Cache of pre-rendered shape bitmaps
+#
+# Created:      17-10-2026
+# Licence:      wxWindows license
+#----------------------------------------------------------------------------
+
+from collections import OrderedDict
+
+import wx
+
+# Default memory budget of the sprite cache in bytes
+DEFAULT_SPRITE_BUDGET = 32 * 1024 * 1024
+
+# Colour marking the transparent parts of a sprite
+SPRITE_MASK_COLOUR = wx.Colour(1, 2, 3)
+
+
+
+class SpriteCache(object):
+    """A least recently used cache of rendered shape bitmaps.
+
+    Each shape has at most one sprite, stored together with a key that
+    describes the state it was rendered in. When the bitmaps take more
+    memory than the budget, the least recently used ones are dropped.
+    """
+    def __init__(self, budget = DEFAULT_SPRITE_BUDGET):
+        self._budget = budget
+        self._size = 0
+        self._sprites = OrderedDict()
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def SetBudget(self, budget):
+        """Set the memory budget in bytes, evicting sprites if necessary."""
+        self._budget = budget
+        self._Evict()
+
+    def GetBudget(self):
+        """Return the memory budget in bytes."""
+        return self._budget
+
+    def GetSize(self):
+        """Return the estimated memory used by the cached bitmaps in bytes."""
+        return self._size
+
+    def _Evict(self):
+        while self._size > self._budget and self._sprites:
+            shape, (key, bitmap, size) = self._sprites.popitem(last = False)
+            self._size -= size
+
+    def Get(self, shape, key):
+        """Return the sprite of shape if it was rendered with the given key,
+        otherwise None.
+        """
+        entry = self._sprites.get(shape)
+        if entry is None or entry[0] != key:
+            return None
+
+        # Mark as most recently used
+        del self._sprites[shape]
+        self._sprites[shape] = entry
+        return entry[1]
+
+    def Put(self, shape, key, bitmap):
+        """Store the sprite of shape, replacing any previous one."""
+        self.Discard(shape)
+
+        size = bitmap.GetWidth() * bitmap.GetHeight() * 4
+        if size > self._budget:
+            return
+        self._sprites[shape] = key, bitmap, size
+        self._size += size
+        self._Evict()
+
+    def Discard(self, shape):
+        """Drop the sprite of shape, if any."""
+        entry = self._sprites.pop(shape, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def Clear(self):
+        """Drop all sprites."""
+        self._sprites = OrderedDict()
+        self._size = 0
+
+
+
+TheSpriteCache = SpriteCache()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# Name:         statedc.py
+# Purpose:      Device context wrapper dropping redundant state changes
+#
+# Created:      17-10-2026
+# Licence:      wxWindows license
+#----------------------------------------------------------------------------
+
+
+
+class StateTrackingDC(object):
+    """Wraps a device context and drops calls that set the pen, brush, font,
+    text colours, background mode, logical function or user scale to the
+    value they already have. The text foreground colour and user scale are
+    only queried from the wrapped DC once. All other methods are passed on
+    to the wrapped DC.
+
+    Pens, brushes and fonts are compared by identity, so calls are only
+    dropped when shapes share the same pen, brush or font object. The
+    wrapper only knows about changes made through it, so the wrapped DC
+    must not be changed directly while the wrapper is in use.
+    """
+    def __init__(self, dc):
+        self._dc = dc
+        self._pen = None
+        self._brush = None
+        self._font = None
+        self._textForeground = None
+        self._textBackground = None
+        self._backgroundMode = None
+        self._logicalFunction = None
+        self._userScale = None
+
+    def __getattr__(self, name):
+        # Look the method up once and keep it as an instance attribute,
+        # later calls then avoid going through __getattr__
+        attr = getattr(self._dc, name)
+        setattr(self, name, attr)
+        return attr
+
+    def GetDC(self):
+        """Return the wrapped device context."""
+        return self._dc
+
+    def ResetState(self):
+        """Forget the tracked state, so the next set calls all reach the
+        wrapped DC. Call this after changing the wrapped DC directly.
+        """
+        self._pen = None
+        self._brush = None
+        self._font = None
+        self._textForeground = None
+        self._textBackground = None
+        self._backgroundMode = None
+        self._logicalFunction = None
+        self._userScale = None
+
+    def SetPen(self, pen):
+        if pen is not self._pen:
+            self._pen = pen
+            self._dc.SetPen(pen)
+
+    def SetBrush(self, brush):
+        if brush is not self._brush:
+            self._brush = brush
+            self._dc.SetBrush(brush)
+
+    def SetFont(self, font):
+        if font is not self._font:
+            self._font = font
+            self._dc.SetFont(font)
+
+    def SetTextForeground(self, colour):
+        if self._textForeground is None or colour != self._textForeground:
+            self._textForeground = colour
+            self._dc.SetTextForeground(colour)
+
+    def GetTextForeground(self):
+        if self._textForeground is None:
+            self._textForeground = self._dc.GetTextForeground()
+        return self._textForeground
+
+    def SetTextBackground(self, colour):
+        if self._textBackground is None or colour != self._textBackground:
+            self._textBackground = colour
+            self._dc.SetTextBackground(colour)
+
+    def SetBackgroundMode(self, mode):
+        if mode != self._backgroundMode:
+            self._backgroundMode = mode
+            self._dc.SetBackgroundMode(mode)
+
+    def SetLogicalFunction(self, function):
+        if function != self._logicalFunction:
+            self._logicalFunction = function
+            self._dc.SetLogicalFunction(function)
+
+    def SetUserScale(self, x, y):
+        if (x, y) != self._userScale:
+            self._userScale = x, y
+            self._dc.SetUserScale(x, y)
+
+    def GetUserScale(self):
+        if self._userScale is None:
+            self._userScale = self._dc.GetUserScale()
+        return self._userScale